@@ -1,17 +1,46 @@
+import argparse
+from time import time
+from typing import List, Optional
+
 from constants import (
     TEAM_R306,
     TEAM_MBDF,
+    TEAM_ROSTERS,
+    DAEMON_POLL_INTERVAL_SEC,
     RunOptions,
 )
-from core_services.match_enemy_stats import MatchEnemyStats
-from core_services.team_data_aggregator import TeamDataAggregator
-from time import time
+from utils import instrumentation
 
 
 class WarzoneData:
+    """
+    Services are built the first time they're used so a command only pays for the clients it needs (e.g. enemy stats
+    never touches Sheets, so it skips the Google client import and OAuth)
+    """
+
     def __init__(self):
-        self.team_data_aggregator = TeamDataAggregator()
-        self.match_enemy_stats = MatchEnemyStats()
+        self._team_data_aggregator = None
+        self._match_enemy_stats = None
+
+    @property
+    def team_data_aggregator(self):
+        if self._team_data_aggregator is None:
+            from core_services.team_data_aggregator import TeamDataAggregator
+
+            self._team_data_aggregator = TeamDataAggregator()
+        return self._team_data_aggregator
+
+    @property
+    def match_enemy_stats(self):
+        if self._match_enemy_stats is None:
+            from core_services.match_enemy_stats import MatchEnemyStats
+
+            self._match_enemy_stats = MatchEnemyStats()
+        return self._match_enemy_stats
+
+    def close(self):
+        if self._match_enemy_stats is not None:
+            self._match_enemy_stats.close()
 
     def prompt_user_for_run_type(self):
         try:
@@ -37,12 +66,13 @@ class WarzoneData:
         print(f"\nAggregating results for {team}...\n")
         return team
 
-    def prompt_user_for_match_id(self):
-        match_id_input = input("Enter the match_id to pull enemy stats for\n")
-        if not match_id_input.isdigit():
-            raise Exception("The match ID should be only numbers")
+    def prompt_user_for_match_ids(self):
+        match_ids_input = input("Enter the match_ids to pull enemy stats for, separated by commas or spaces\n")
+        match_ids = match_ids_input.replace(",", " ").split()
+        if not match_ids or not all(match_id.isdigit() for match_id in match_ids):
+            raise Exception("The match IDs should be only numbers")
 
-        return match_id_input
+        return match_ids
 
     def run(self):
         start_time = time()
@@ -51,12 +81,180 @@ class WarzoneData:
             team = self.prompt_user_for_team()
             self.team_data_aggregator.run_for_team(team)
         else:
-            match_id = self.prompt_user_for_match_id()
-            self.match_enemy_stats.display_stats_for_enemies_in_match(match_id)
+            match_ids = self.prompt_user_for_match_ids()
+            self.match_enemy_stats.display_stats_for_enemies_in_matches(match_ids)
         end_time = time()
         print(f"Run took {end_time-start_time} seconds")
 
+    def run_teams(self, teams: Optional[List[str]] = None):
+        """
+        Non-interactive entry point (e.g. for a nightly cron). Updates every team in TEAM_ROSTERS if no teams are given
+        """
+        start_time = time()
+        if teams:
+            self.team_data_aggregator.run_for_teams(teams)
+        else:
+            self.team_data_aggregator.run_for_all_teams()
+        end_time = time()
+        print(f"Run took {end_time-start_time} seconds")
 
-if __name__ == "__main__":
+    def run_all_teams(self):
+        self.run_teams()
+
+    def run_enemy_stats(self, match_ids: List[str], offline: bool = False):
+        """
+        Non-interactive entry point that reports on every lobby in match_ids
+        """
+        start_time = time()
+        self.match_enemy_stats.display_stats_for_enemies_in_matches(match_ids, offline)
+        end_time = time()
+        print(f"Run took {end_time-start_time} seconds")
+
+    def run_backfill(
+        self,
+        teams: Optional[List[str]] = None,
+        max_pages: Optional[int] = None,
+        restart: bool = False,
+        write_sheets: bool = False,
+    ):
+        """
+        Non-interactive entry point that pulls the full match history of every player on the given teams (default:
+        all). Safe to interrupt and re-run, it carries on from where it stopped
+        """
+        from core_services.match_history_backfill import MatchHistoryBackfill
+
+        start_time = time()
+        MatchHistoryBackfill(max_pages=max_pages).backfill_teams(teams or list(TEAM_ROSTERS), restart, write_sheets)
+        end_time = time()
+        print(f"Run took {end_time-start_time} seconds")
+
+    def run_daemon(
+        self,
+        teams: Optional[List[str]] = None,
+        poll_interval_sec: float = DAEMON_POLL_INTERVAL_SEC,
+        max_polls: Optional[int] = None,
+    ):
+        """
+        Long-running entry point that keeps the given teams' sheets (default: all) up to date until interrupted
+        """
+        from core_services.sync_daemon import SyncDaemon
+
+        team_data_aggregator = self.team_data_aggregator
+        sync_daemon = SyncDaemon(
+            teams or list(TEAM_ROSTERS),
+            poll_interval_sec,
+            scraper=team_data_aggregator.scraper,
+            google_sheets_api=team_data_aggregator.google_sheets_api,
+        )
+        print(f"Polling for new matches every {poll_interval_sec} seconds, press Ctrl+C to stop")
+        try:
+            sync_daemon.run(max_polls)
+        except KeyboardInterrupt:
+            print("Stopped polling")
+
+
+def match_id_arg(value: str) -> str:
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(f"{value} is not a match ID, they should be only numbers")
+    return value
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Warzone team and lobby stats. Prompts for what to do if no command")
+    parser.add_argument("--all-teams", action="store_true", help="Same as 'team' with no --team")
+    parser.add_argument(
+        "--matches", nargs="+", type=match_id_arg, metavar="MATCH_ID", help="Same as 'enemies' with these match IDs"
+    )
+    fixtures_group = parser.add_mutually_exclusive_group()
+    fixtures_group.add_argument("--record-fixtures", metavar="DIR", help="Save every HTTP response under DIR")
+    fixtures_group.add_argument(
+        "--replay-fixtures", metavar="DIR", help="Answer HTTP requests from responses saved under DIR"
+    )
+    parser.add_argument("--metrics-json", metavar="PATH", help="Write the run's timings and counters as JSON")
+    parser.add_argument(
+        "--metrics-prom", metavar="PATH", help="Write the run's timings and counters as a Prometheus textfile"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    team_parser = subparsers.add_parser("team", help="Fetch new matches and upload team stats to Sheets")
+    team_parser.add_argument(
+        "--team", action="append", choices=list(TEAM_ROSTERS), help="Team to update, can be repeated (default: all)"
+    )
+
+    enemies_parser = subparsers.add_parser("enemies", help="Pull stats about the enemies in one or more matches")
+    enemies_parser.add_argument("match_ids", nargs="*", type=match_id_arg)
+    enemies_parser.add_argument(
+        "--matches",
+        nargs="+",
+        type=match_id_arg,
+        default=[],
+        dest="enemy_match_ids",
+        metavar="MATCH_ID",
+        help="Match IDs to report on, as well as or instead of the positional ones",
+    )
+    enemies_parser.add_argument(
+        "--offline", action="store_true", help="Rate players from stored lobbies where possible"
+    )
+
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="Pull players' full match history into the local match store, resuming where it stopped"
+    )
+    backfill_parser.add_argument(
+        "--team", action="append", choices=list(TEAM_ROSTERS), help="Team to backfill, can be repeated (default: all)"
+    )
+    backfill_parser.add_argument(
+        "--max-pages", type=int, help="Pages of 20 matches to walk per player in this run (default: all of them)"
+    )
+    backfill_parser.add_argument(
+        "--restart", action="store_true", help="Walk the history from the most recent match again"
+    )
+    backfill_parser.add_argument(
+        "--write-sheets", action="store_true", help="Add backfilled matches older than the sheets' first rows"
+    )
+
+    daemon_parser = subparsers.add_parser("daemon", help="Keep team stats in Sheets up to date by polling")
+    daemon_parser.add_argument(
+        "--team", action="append", choices=list(TEAM_ROSTERS), help="Team to poll for, can be repeated (default: all)"
+    )
+    daemon_parser.add_argument(
+        "--interval", type=float, default=DAEMON_POLL_INTERVAL_SEC, help="Seconds between polls for new matches"
+    )
+    daemon_parser.add_argument("--max-polls", type=int, help="Stop after this many polls (default: run until stopped)")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.command == "enemies" and not args.match_ids + args.enemy_match_ids:
+        parser.error("enemies needs at least one match ID")
+    if args.record_fixtures or args.replay_fixtures:
+        from external_services.http_fixtures import configure_fixtures, FixtureMode
+
+        mode = FixtureMode.RECORD if args.record_fixtures else FixtureMode.REPLAY
+        configure_fixtures(mode, args.record_fixtures or args.replay_fixtures)
     wz_data = WarzoneData()
-    wz_data.run()
+    try:
+        if args.command == "team":
+            wz_data.run_teams(args.team)
+        elif args.command == "enemies":
+            wz_data.run_enemy_stats(args.match_ids + args.enemy_match_ids, args.offline)
+        elif args.command == "backfill":
+            wz_data.run_backfill(args.team, args.max_pages, args.restart, args.write_sheets)
+        elif args.command == "daemon":
+            wz_data.run_daemon(args.team, args.interval, args.max_polls)
+        elif args.all_teams:
+            wz_data.run_all_teams()
+        elif args.matches:
+            wz_data.run_enemy_stats(args.matches)
+        else:
+            wz_data.run()
+    finally:
+        wz_data.close()
+        # Failed runs are the ones most worth looking at, so always report what happened
+        instrumentation.print_summary()
+        instrumentation.dump(args.metrics_json, args.metrics_prom)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Times the main workflows end to end against the local stand-in server (or a recorded fixture corpus), plus match
+decoding and row building on full lobbies, so regressions show up as numbers
+Usage: python -m benchmarks.bench_end_to_end [--latency-ms 20] [--throttle 0.02] [--output results.json]
+       python -m benchmarks.bench_end_to_end --record-fixtures fixtures/
+       python -m benchmarks.bench_end_to_end --replay-fixtures fixtures/
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter
+from typing import Dict, Callable, Any
+
+from benchmarks.fake_server import FakeServer, FakeServerConfig, LocalRedirectSession
+from benchmarks.fixtures import build_match_payload
+from constants import TEAM_ROSTERS, TEAM_R306
+from external_services.google_sheets_api import OVERALL_SHEET
+from schemas.warzone_match_decoder import decode_warzone_match, load_json
+from utils import instrumentation
+
+NUM_DECODED_MATCHES = 200
+NUM_ROW_MATCHES = 500
+
+
+def timed(results: Dict[str, float], stage: str, func: Callable[[], Any]) -> Any:
+    start = perf_counter()
+    result = func()
+    results[stage] = perf_counter() - start
+    print(f"{stage}: {round(results[stage], 3)}s")
+    return result
+
+
+def bench_decoding(results: Dict[str, float]) -> None:
+    body = json.dumps({"data": build_match_payload()}).encode("utf-8")
+    timed(
+        results,
+        f"decode_{NUM_DECODED_MATCHES}_matches",
+        lambda: [decode_warzone_match(load_json(body)["data"]) for _ in range(NUM_DECODED_MATCHES)],
+    )
+    try:
+        from schemas.warzone_match_schema import WARZONE_MATCH_SCHEMA
+    except ImportError:
+        print("marshmallow isn't installed, skipping schema loading")
+        return
+    timed(
+        results,
+        f"schema_load_{NUM_DECODED_MATCHES}_matches",
+        lambda: [WARZONE_MATCH_SCHEMA.load(load_json(body)["data"]) for _ in range(NUM_DECODED_MATCHES)],
+    )
+
+
+def bench_row_building(results: Dict[str, float], team: str) -> None:
+    from core_services.row_builder import RowBuilder
+
+    gamertags = [player.display_name for player in TEAM_ROSTERS[team]]
+    matches = [
+        decode_warzone_match(build_match_payload(match_id=str(idx), seed=idx, gamertags=gamertags))
+        for idx in range(NUM_ROW_MATCHES)
+    ]
+
+    def build_rows():
+        row_builder = RowBuilder()
+        for gamertag in gamertags:
+            row_builder.build_individual_rows(gamertag, matches)
+        row_builder.build_team_rows(matches)
+
+    timed(results, f"build_rows_{NUM_ROW_MATCHES}_matches", build_rows)
+
+
+def bench_workflows(results: Dict[str, float], team: str, base_url: str = None) -> None:
+    from core_services.match_enemy_stats import MatchEnemyStats
+    from core_services.sync_daemon import SyncDaemon
+    from core_services.team_data_aggregator import TeamDataAggregator
+    from external_services.cod_tracker_scraper import CodTrackerScraper
+    from external_services.google_sheets_api import GoogleSheetsApi
+    from external_services.http_transport import HttpTransport
+
+    # Requests keep their real URLs and are only redirected at the session, so a corpus recorded against the
+    # stand-in server replays the same way as one recorded against the real services
+    def build_session():
+        return LocalRedirectSession(base_url) if base_url else None
+
+    def build_aggregator():
+        return TeamDataAggregator(
+            scraper=CodTrackerScraper(transport=HttpTransport(session=build_session())),
+            google_sheets_api=GoogleSheetsApi(session=build_session()),
+        )
+
+    aggregator = build_aggregator()
+    timed(results, "run_for_team_cold", lambda: aggregator.run_for_team(team))
+    # A fresh aggregator sees nothing new on the sheets, so this is the cost of an up-to-date run
+    aggregator = build_aggregator()
+    timed(results, "run_for_team_up_to_date", lambda: aggregator.run_for_team(team))
+    # The daemon's first poll reads the sheets' checkpoints, later ones only ask tracker.gg whether anything changed
+    sync_daemon = SyncDaemon([team], scraper=aggregator.scraper, google_sheets_api=aggregator.google_sheets_api)
+    timed(results, "daemon_first_poll", sync_daemon.poll_once)
+    timed(results, "daemon_poll_up_to_date", sync_daemon.poll_once)
+
+    match_ids = aggregator.scraper.get_all_new_match_ids_for_player(TEAM_ROSTERS[team][0], None)
+    if not match_ids:
+        print("No matches found, skipping enemy stats")
+        return
+    match_id = match_ids[0]
+    match_enemy_stats = MatchEnemyStats(scraper=CodTrackerScraper(transport=HttpTransport(session=build_session())))
+    timed(results, "enemy_stats_cold", lambda: match_enemy_stats.pull_stats_for_enemies_in_match(match_id))
+    timed(results, "enemy_stats_cached", lambda: match_enemy_stats.pull_stats_for_enemies_in_match(match_id))
+    match_enemy_stats.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--team", default=TEAM_R306, choices=list(TEAM_ROSTERS))
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every stand-in server response")
+    parser.add_argument("--throttle", type=float, default=0, help="Share of tracker.gg requests answered with 429")
+    parser.add_argument("--num-matches", type=int, default=100, help="Matches in each player's history")
+    fixtures_group = parser.add_mutually_exclusive_group()
+    fixtures_group.add_argument("--replay-fixtures", help="Replay a fixture corpus instead of using the server")
+    fixtures_group.add_argument("--record-fixtures", help="Record the stand-in server's responses to a fixture corpus")
+    parser.add_argument("--output", help="Write the timings to this JSON file")
+    args = parser.parse_args()
+
+    results: Dict[str, float] = {}
+    bench_decoding(results)
+    bench_row_building(results, args.team)
+
+    # Every store the workflows write to lives in a scratch directory, so each run starts cold
+    output_path = os.path.abspath(args.output) if args.output else None
+    replay_path = os.path.abspath(args.replay_fixtures) if args.replay_fixtures else None
+    record_path = os.path.abspath(args.record_fixtures) if args.record_fixtures else None
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        os.chdir(scratch_dir)
+        if replay_path or record_path:
+            from external_services.http_fixtures import configure_fixtures, FixtureMode
+
+            configure_fixtures(FixtureMode.REPLAY if replay_path else FixtureMode.RECORD, replay_path or record_path)
+        if replay_path:
+            bench_workflows(results, args.team)
+        else:
+            config = FakeServerConfig(
+                latency_sec=args.latency_ms / 1000,
+                throttle_probability=args.throttle,
+                num_matches=args.num_matches,
+                team_gamertags=[player.display_name for player in TEAM_ROSTERS[args.team]],
+                sheet_names=[player.name for player in TEAM_ROSTERS[args.team]] + [OVERALL_SHEET],
+            )
+            with FakeServer(config) as server:
+                bench_workflows(results, args.team, server.base_url)
+                print(f"Stand-in server: {server.get_stats()}")
+
+    # Breaks the workflow timings down by stage and endpoint
+    instrumentation.print_summary()
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
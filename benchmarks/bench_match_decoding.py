@@ -0,0 +1,33 @@
+"""
+Compares the fast match decoder against the marshmallow schema on full 150 player lobbies
+Usage: python -m benchmarks.bench_match_decoding
+"""
+
+import copy
+import json
+from timeit import timeit
+
+from benchmarks.fixtures import build_match_payload
+from schemas.warzone_match_decoder import decode_warzone_match, load_json
+
+NUM_MATCHES = 200
+
+
+def main():
+    payload = build_match_payload()
+    body = json.dumps({"data": payload}).encode("utf-8")
+    payloads = [copy.deepcopy(payload) for _ in range(NUM_MATCHES)]
+
+    fast_sec = timeit(lambda: [decode_warzone_match(load_json(body)["data"]) for _ in range(NUM_MATCHES)], number=1)
+    print(f"Fast decoder (incl. JSON parse): {round(1000 * fast_sec / NUM_MATCHES, 3)}ms per match")
+
+    from schemas.warzone_match_schema import WARZONE_MATCH_SCHEMA
+
+    assert WARZONE_MATCH_SCHEMA.load(copy.deepcopy(payload)) == decode_warzone_match(payload)
+    strict_sec = timeit(lambda: [WARZONE_MATCH_SCHEMA.load(p) for p in payloads], number=1)
+    print(f"Marshmallow schema (excl. JSON parse): {round(1000 * strict_sec / NUM_MATCHES, 3)}ms per match")
+    print(f"Speedup: {round(strict_sec / fast_sec, 1)}x")
+
+
+if __name__ == "__main__":
+    main()
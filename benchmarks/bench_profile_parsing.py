@@ -0,0 +1,36 @@
+"""
+Compares parsing a whole profile page with html.parser against the fragment parser
+Usage: python -m benchmarks.bench_profile_parsing
+"""
+
+from timeit import timeit
+
+from bs4 import BeautifulSoup
+
+from benchmarks.fixtures import build_profile_page
+from external_services.profile_page_parser import (
+    PARSER_BACKEND,
+    parse_last_7d_kd_ratio,
+    _find_last_7d_kd_ratio,
+)
+
+NUM_PAGES = 20
+
+
+def main():
+    html = build_profile_page(kd=1.23)
+    print(f"Page size: {len(html) // 1024}KiB, parser backend: {PARSER_BACKEND}")
+
+    def parse_full_page_with_html_parser():
+        return _find_last_7d_kd_ratio(BeautifulSoup(html, "html.parser"))
+
+    assert parse_full_page_with_html_parser() == parse_last_7d_kd_ratio(html) == 1.23
+    before_sec = timeit(parse_full_page_with_html_parser, number=NUM_PAGES)
+    after_sec = timeit(lambda: parse_last_7d_kd_ratio(html), number=NUM_PAGES)
+    print(f"Full page, html.parser: {round(1000 * before_sec / NUM_PAGES, 2)}ms per page")
+    print(f"Fragment, {PARSER_BACKEND}: {round(1000 * after_sec / NUM_PAGES, 2)}ms per page")
+    print(f"Speedup: {round(before_sec / after_sec, 1)}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures how long the CLI takes to start and which heavy modules each command imports before doing any work
+Usage: python -m benchmarks.bench_startup
+"""
+
+import subprocess
+import sys
+from time import perf_counter
+
+NUM_RUNS = 5
+HEAVY_MODULES = ("googleapiclient", "google_auth_oauthlib", "bs4", "marshmallow", "requests")
+# Imports the CLI and the modules a command needs, without building any services or touching the network
+COMMAND_IMPORTS = {
+    "--help": "import app",
+    "enemies": "import app, core_services.match_enemy_stats",
+    "backfill": "import app, core_services.match_history_backfill",
+    "team": "import app, core_services.team_data_aggregator",
+}
+
+
+def time_command(code: str) -> float:
+    start = perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+    return perf_counter() - start
+
+
+def get_heavy_imports(code: str) -> list:
+    check = f"{code}; import sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True).stdout
+    return [module for module in output.strip().split(",") if module]
+
+
+def main():
+    baseline_sec = min(time_command("pass") for _ in range(NUM_RUNS))
+    print(f"Bare interpreter: {round(1000 * baseline_sec, 1)}ms")
+    for command, code in COMMAND_IMPORTS.items():
+        try:
+            get_heavy_imports(code)
+        except subprocess.CalledProcessError as e:
+            print(f"{command}: failed to import\n{e.stderr.strip().splitlines()[-1]}")
+            continue
+        startup_sec = min(time_command(code) for _ in range(NUM_RUNS))
+        heavy_imports = get_heavy_imports(code)
+        print(
+            f"{command}: {round(1000 * (startup_sec - baseline_sec), 1)}ms over the bare interpreter, "
+            f"heavy imports: {', '.join(heavy_imports) or 'none'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+"""
+Local stand-in for tracker.gg and the Sheets API, for benchmarks and offline runs. It serves synthetic match history,
+lobbies, search results and profile pages, keeps spreadsheets in memory, and can add latency and answer a share of
+tracker.gg requests with 429s. Sheets requests are never throttled since SheetsRestClient doesn't retry.
+Match history pages carry ETags and answer If-None-Match with 304s, and POST /_add_matches plays new matches
+Usage: python -m benchmarks.fake_server --port 8000 --latency-ms 50 --throttle 0.05
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import urllib.parse
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import List, Dict, Optional, Tuple, Any
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from benchmarks.fixtures import build_match_payload, build_profile_page
+
+MATCH_PAGE_SIZE = 20
+FIRST_MATCH_ID = 13637374812364560000
+FIRST_MATCH_START_TS = 1609459200
+MATCH_INTERVAL_SEC = 30 * 60
+DEFAULT_ROW_COUNT = 1000
+A1_CELL_PATTERN = re.compile(r"^([A-Z]*)(\d*)$")
+
+
+@dataclass
+class FakeServerConfig:
+    latency_sec: float = 0.0
+    # Share of tracker.gg requests answered with a 429
+    throttle_probability: float = 0.0
+    retry_after_sec: int = 0
+    # Every player's history holds the same matches, most recent first, as if the whole team always played together
+    num_matches: int = 100
+    team_gamertags: List[str] = field(default_factory=list)
+    # Tabs each spreadsheet starts with, holding just a header row
+    sheet_names: List[str] = field(default_factory=list)
+    seed: int = 0
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def parse_a1_range(a1_range: str) -> Tuple[str, int, Optional[int], int, Optional[int]]:
+    """
+    :return: Sheet name, first row, last row (None if open ended), first column, last column (None if open ended).
+    Rows and columns are 0 based
+    """
+    sheet, _, cells = a1_range.partition("!")
+    if sheet.startswith("'") and sheet.endswith("'"):
+        sheet = sheet[1:-1]
+    start, _, end = cells.partition(":")
+    start_col, start_row = A1_CELL_PATTERN.match(start).groups() if cells else ("", "")
+    end_col, end_row = A1_CELL_PATTERN.match(end).groups() if end else (start_col, start_row)
+    return (
+        sheet,
+        int(start_row) - 1 if start_row else 0,
+        int(end_row) - 1 if end_row else None,
+        _column_index(start_col) if start_col else 0,
+        _column_index(end_col) if end_col else None,
+    )
+
+
+class FakeSpreadsheets:
+    def __init__(self, sheet_names: List[str]):
+        self.sheet_names = sheet_names
+        self.spreadsheets: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _get_spreadsheet(self, spreadsheet_id: str) -> Dict[str, Dict[str, Any]]:
+        if spreadsheet_id not in self.spreadsheets:
+            self.spreadsheets[spreadsheet_id] = {}
+            for sheet in self.sheet_names:
+                self._add_sheet(spreadsheet_id, sheet, DEFAULT_ROW_COUNT, [["match_id"]])
+        return self.spreadsheets[spreadsheet_id]
+
+    def _add_sheet(self, spreadsheet_id: str, title: str, row_count: int, rows: List[List[str]]) -> None:
+        sheets = self.spreadsheets[spreadsheet_id]
+        sheets[title] = {"sheet_id": len(sheets) + 1, "row_count": row_count, "rows": rows}
+
+    def get(self, spreadsheet_id: str) -> Dict[str, Any]:
+        with self._lock:
+            sheets = self._get_spreadsheet(spreadsheet_id)
+            return {
+                "sheets": [
+                    {
+                        "properties": {
+                            "sheetId": sheet["sheet_id"],
+                            "title": title,
+                            "gridProperties": {"rowCount": sheet["row_count"]},
+                        }
+                    }
+                    for title, sheet in sheets.items()
+                ]
+            }
+
+    def batch_update(self, spreadsheet_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            # Like the real API, a batch either applies completely or not at all
+            snapshot = copy.deepcopy(self._get_spreadsheet(spreadsheet_id))
+            try:
+                return self._apply_batch_update(spreadsheet_id, body)
+            except Exception:
+                self.spreadsheets[spreadsheet_id] = snapshot
+                raise
+
+    def _apply_batch_update(self, spreadsheet_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        sheets = self._get_spreadsheet(spreadsheet_id)
+        for request in body["requests"]:
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                row_count = properties.get("gridProperties", {}).get("rowCount", DEFAULT_ROW_COUNT)
+                self._add_sheet(spreadsheet_id, properties["title"], row_count, [])
+            elif "appendDimension" in request:
+                sheet_id = request["appendDimension"]["sheetId"]
+                sheet = next(sheet for sheet in sheets.values() if sheet["sheet_id"] == sheet_id)
+                sheet["row_count"] += request["appendDimension"]["length"]
+            elif "insertDimension" in request:
+                dimension_range = request["insertDimension"]["range"]
+                sheet = next(sheet for sheet in sheets.values() if sheet["sheet_id"] == dimension_range["sheetId"])
+                num_rows = dimension_range["endIndex"] - dimension_range["startIndex"]
+                start = dimension_range["startIndex"]
+                sheet["rows"][start:start] = [[] for _ in range(num_rows)] if start < len(sheet["rows"]) else []
+                sheet["row_count"] += num_rows
+            elif "pasteData" in request:
+                paste_data = request["pasteData"]
+                coordinate = paste_data["coordinate"]
+                sheet = next(sheet for sheet in sheets.values() if sheet["sheet_id"] == coordinate["sheetId"])
+                values = [line.split(paste_data["delimiter"]) for line in paste_data["data"].split("\n")]
+                self._write(sheet, coordinate.get("rowIndex", 0), coordinate.get("columnIndex", 0), values)
+        return {"spreadsheetId": spreadsheet_id, "replies": [{} for _ in body["requests"]]}
+
+    def batch_get_values(self, spreadsheet_id: str, ranges: List[str]) -> Dict[str, Any]:
+        with self._lock:
+            sheets = self._get_spreadsheet(spreadsheet_id)
+            value_ranges = []
+            for a1_range in ranges:
+                sheet, start_row, end_row, start_col, end_col = parse_a1_range(a1_range)
+                if sheet not in sheets:
+                    raise KeyError(f"Unable to parse range: {a1_range}")
+                rows = sheets[sheet]["rows"][start_row : None if end_row is None else end_row + 1]
+                values = [row[start_col : None if end_col is None else end_col + 1] for row in rows]
+                while values and not any(values[-1]):
+                    values.pop()
+                value_range = {"range": a1_range, "majorDimension": "ROWS"}
+                if values:
+                    value_range["values"] = values
+                value_ranges.append(value_range)
+            return {"spreadsheetId": spreadsheet_id, "valueRanges": value_ranges}
+
+    @staticmethod
+    def _to_cell(value: Any) -> str:
+        # Like USER_ENTERED input, a leading apostrophe only marks the value as text and isn't stored
+        value = str(value)
+        return value[1:] if value.startswith("'") else value
+
+    def _write(self, sheet: Dict[str, Any], start_row: int, start_col: int, values: List[List[str]]) -> None:
+        rows = sheet["rows"]
+        if start_row + len(values) > sheet["row_count"]:
+            raise ValueError(f"Range exceeds grid limits. Max rows: {sheet['row_count']}")
+        while len(rows) < start_row + len(values):
+            rows.append([])
+        for offset, values_row in enumerate(values):
+            row = rows[start_row + offset]
+            row.extend([""] * (start_col + len(values_row) - len(row)))
+            row[start_col : start_col + len(values_row)] = [self._to_cell(value) for value in values_row]
+
+    def batch_update_values(self, spreadsheet_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            sheets = self._get_spreadsheet(spreadsheet_id)
+            for value_range in body["data"]:
+                sheet, start_row, _, start_col, _ = parse_a1_range(value_range["range"])
+                if sheet not in sheets:
+                    raise KeyError(f"Unable to parse range: {value_range['range']}")
+                self._write(sheets[sheet], start_row, start_col, value_range["values"])
+            return {"spreadsheetId": spreadsheet_id, "totalUpdatedRows": sum(len(d["values"]) for d in body["data"])}
+
+
+class FakeTracker:
+    def __init__(self, config: FakeServerConfig):
+        self.config = config
+        self.match_ids = []
+        self.match_start_ts = {}
+        self._lock = threading.Lock()
+        self.add_matches(config.num_matches)
+
+    def add_matches(self, num_matches: int) -> None:
+        with self._lock:
+            for _ in range(num_matches):
+                match_id = str(FIRST_MATCH_ID + len(self.match_ids))
+                self.match_start_ts[match_id] = FIRST_MATCH_START_TS + len(self.match_ids) * MATCH_INTERVAL_SEC
+                self.match_ids.insert(0, match_id)
+
+    def get_match_page(self, next_token: str) -> Dict[str, Any]:
+        # Tokens are offsets from the most recent match, so new matches shift older pages like a real feed would
+        start = 0 if next_token in ("", "null") else int(next_token)
+        with self._lock:
+            page = self.match_ids[start : start + MATCH_PAGE_SIZE]
+            has_more = start + MATCH_PAGE_SIZE < len(self.match_ids)
+        return {
+            "data": {
+                "matches": [
+                    {"attributes": {"id": match_id}, "metadata": {"timestamp": self.match_start_ts[match_id]}}
+                    for match_id in page
+                ],
+                "metadata": {"next": str(start + MATCH_PAGE_SIZE) if has_more else None},
+            }
+        }
+
+    @lru_cache(maxsize=1024)
+    def get_match(self, match_id: str) -> bytes:
+        payload = build_match_payload(
+            match_id=match_id,
+            start_time_ts=self.match_start_ts.get(match_id, FIRST_MATCH_START_TS),
+            seed=zlib.crc32(match_id.encode("utf-8")) + self.config.seed,
+            gamertags=self.config.team_gamertags,
+        )
+        return json.dumps({"data": payload}).encode("utf-8")
+
+    @staticmethod
+    def search(query: str) -> Dict[str, Any]:
+        activision_id = zlib.crc32(query.encode("utf-8")) % 10000000
+        return {"data": [{"platformUserIdentifier": f"{query}#{activision_id}"}]}
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _get_profile_page(kd: float) -> bytes:
+        return build_profile_page(kd=kd).encode("utf-8")
+
+    def get_profile_page(self, username: str) -> bytes:
+        kd = round(0.5 + (zlib.crc32(username.encode("utf-8")) % 250) / 100, 2)
+        return self._get_profile_page(kd)
+
+
+class FakeServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json", headers=None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: Dict[str, Any]) -> None:
+        self._send(status, json.dumps(data).encode("utf-8"))
+
+    def _read_json_body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def _handle(self, method: str) -> None:
+        server = self.server
+        parsed = urllib.parse.urlsplit(self.path)
+        path = parsed.path
+        query = urllib.parse.parse_qs(parsed.query)
+        body = self._read_json_body() if method == "POST" else {}
+        server.count(path)
+        if path == "/_stats":
+            return self._send_json(200, server.get_stats())
+        if path == "/_add_matches":
+            server.tracker.add_matches(int(body.get("count", 1)))
+            return self._send_json(200, {"num_matches": len(server.tracker.match_ids)})
+        if server.config.latency_sec:
+            sleep(server.config.latency_sec)
+        try:
+            if path.startswith("/v4/spreadsheets/"):
+                return self._handle_sheets(method, path[len("/v4/spreadsheets/") :], query, body)
+            if server.should_throttle():
+                headers = {"Retry-After": str(server.config.retry_after_sec)}
+                return self._send(429, b'{"errors": ["rate limited"]}', headers=headers)
+            return self._handle_tracker(path, query)
+        except (KeyError, ValueError) as e:
+            return self._send_json(400, {"error": {"code": 400, "message": str(e)}})
+
+    def _handle_tracker(self, path: str, query: Dict[str, List[str]]) -> None:
+        tracker = self.server.tracker
+        segments = [urllib.parse.unquote(segment) for segment in path.strip("/").split("/")]
+        if path.startswith("/api/v1/warzone/matches/atvi/"):
+            body = json.dumps(tracker.get_match_page(query.get("next", ["null"])[0])).encode("utf-8")
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", headers={"ETag": etag})
+            return self._send(200, body, headers={"ETag": etag})
+        if path.startswith("/api/v1/warzone/matches/"):
+            return self._send(200, tracker.get_match(segments[-1]))
+        if path == "/api/v2/warzone/standard/search":
+            return self._send_json(200, tracker.search(query["query"][0]))
+        if path.startswith("/warzone/profile/"):
+            return self._send(200, tracker.get_profile_page(segments[-1]), content_type="text/html")
+        return self._send_json(404, {"errors": [f"Unknown path {path}"]})
+
+    def _handle_sheets(self, method: str, path: str, query: Dict[str, List[str]], body: Dict[str, Any]) -> None:
+        spreadsheets = self.server.spreadsheets
+        spreadsheet_id, _, values_path = path.partition("/values")
+        spreadsheet_id = urllib.parse.unquote(spreadsheet_id)
+        if values_path == ":batchGet":
+            return self._send_json(200, spreadsheets.batch_get_values(spreadsheet_id, query.get("ranges", [])))
+        if values_path == ":batchUpdate":
+            return self._send_json(200, spreadsheets.batch_update_values(spreadsheet_id, body))
+        if spreadsheet_id.endswith(":batchUpdate"):
+            return self._send_json(200, spreadsheets.batch_update(spreadsheet_id[: -len(":batchUpdate")], body))
+        return self._send_json(200, spreadsheets.get(spreadsheet_id))
+
+
+class FakeHttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: FakeServerConfig):
+        super().__init__(address, FakeServerHandler)
+        self.config = config
+        self.tracker = FakeTracker(config)
+        self.spreadsheets = FakeSpreadsheets(config.sheet_names)
+        self.rng = random.Random(config.seed)
+        self.request_counts: Dict[str, int] = {}
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_route(path: str) -> str:
+        """
+        Groups requests the way HttpTransport names its endpoints
+        """
+        if path.startswith("/v4/"):
+            return "sheets"
+        if path.startswith("/api/v1/warzone/matches/atvi/"):
+            return "match_ids"
+        if path.startswith("/api/v1/warzone/matches/"):
+            return "match"
+        if path.startswith("/api/v2/warzone/standard/search"):
+            return "search"
+        if path.startswith("/warzone/profile/"):
+            return "profile"
+        return path
+
+    def count(self, path: str) -> None:
+        route = self._get_route(path)
+        with self._lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+
+    def should_throttle(self) -> bool:
+        with self._lock:
+            throttle = self.rng.random() < self.config.throttle_probability
+            self.throttled_count += throttle
+            return throttle
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"requests": dict(self.request_counts), "throttled": self.throttled_count}
+
+
+def _serve(config: FakeServerConfig, port: int, port_queue) -> None:
+    server = FakeHttpServer(("127.0.0.1", port), config)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeServer:
+    """
+    Runs the stand-in server in its own process, so serving requests doesn't compete with the code being measured
+    for the GIL
+    """
+
+    def __init__(self, config: Optional[FakeServerConfig] = None, port: int = 0):
+        self.config = config if config else FakeServerConfig()
+        self.port = port
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/"
+
+    def start(self) -> "FakeServer":
+        port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, args=(self.config, self.port, port_queue), daemon=True)
+        self._process.start()
+        self.port = port_queue.get(timeout=10)
+        return self
+
+    def stop(self) -> None:
+        if self._process:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return requests.get(self.base_url + "_stats").json()
+
+    def add_matches(self, num_matches: int) -> None:
+        requests.post(self.base_url + "_add_matches", json={"count": num_matches}).raise_for_status()
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+class LocalRedirectSession(requests.Session):
+    """
+    Session that sends every request to the stand-in server, whatever host the URL names, so the scraper's
+    tracker.gg URLs can be used unchanged
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 16):
+        super().__init__()
+        self.base_url = urllib.parse.urlsplit(base_url)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        url = urllib.parse.urlunsplit((self.base_url.scheme, self.base_url.netloc, parts.path, parts.query, ""))
+        return super().request(method, url, *args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for tracker.gg and the Sheets API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle", type=float, default=0, help="Share of tracker.gg requests answered with 429")
+    parser.add_argument("--num-matches", type=int, default=100)
+    args = parser.parse_args()
+    config = FakeServerConfig(
+        latency_sec=args.latency_ms / 1000, throttle_probability=args.throttle, num_matches=args.num_matches
+    )
+    server = FakeHttpServer(("127.0.0.1", args.port), config)
+    print(f"Serving on http://127.0.0.1:{server.server_address[1]}/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import random
+from typing import Dict, Any, Sequence
+
+LOBBY_SIZE = 150
+PLAYERS_PER_TEAM = 4
+
+
+def _stat(value: int) -> Dict[str, Any]:
+    return {"value": value, "displayValue": str(value), "displayType": "Number"}
+
+
+def build_match_segment(gamertag: str, team_placement: int, rng: random.Random) -> Dict[str, Any]:
+    return {
+        "type": "player",
+        "attributes": {"platformUserIdentifier": gamertag, "team": f"team_{team_placement}"},
+        "metadata": {"platformUserHandle": gamertag, "clanTag": None},
+        "stats": {
+            "kills": _stat(rng.randint(0, 15)),
+            "deaths": _stat(rng.randint(0, 5)),
+            "gulagKills": _stat(rng.randint(0, 1)),
+            "gulagDeaths": _stat(rng.randint(0, 1)),
+            "damageDone": _stat(rng.randint(0, 5000)),
+            "timePlayed": _stat(rng.randint(60, 1800)),
+            "teamPlacement": _stat(team_placement),
+            "score": _stat(rng.randint(0, 10000)),
+            "headshots": _stat(rng.randint(0, 5)),
+        },
+    }
+
+
+def build_match_payload(
+    match_id: str = "13637374812364562301",
+    num_players: int = LOBBY_SIZE,
+    mode_name: str = "BR Quads",
+    start_time_ts: int = 1609459200,
+    seed: int = 0,
+    gamertags: Sequence[str] = (),
+) -> Dict[str, Any]:
+    """
+    Builds the "data" object of a MATCH_DATA_URL response for a synthetic lobby. The given gamertags take the first
+    slots, so they end up teammates
+    """
+    rng = random.Random(seed)
+    num_teams = (num_players + PLAYERS_PER_TEAM - 1) // PLAYERS_PER_TEAM
+    return {
+        "attributes": {"id": match_id, "mapId": "mp_don3", "modeId": "br_brquads"},
+        "metadata": {
+            "modeName": mode_name,
+            "timestamp": start_time_ts,
+            "playerCount": num_players,
+            "teamCount": num_teams,
+            "duration": {"value": 1800000},
+        },
+        "segments": [
+            build_match_segment(
+                gamertags[idx] if idx < len(gamertags) else f"player_{idx}", idx // PLAYERS_PER_TEAM + 1, rng
+            )
+            for idx in range(num_players)
+        ],
+    }
+
+
+def _build_stat_block(name: str, value: str) -> str:
+    return f'<div class="numbers"><span class="name">{name}</span><span class="value">{value}</span></div>'
+
+
+def build_profile_page(kd: float = 1.23, num_filler_sections: int = 400) -> str:
+    """
+    Builds an HTML page shaped like a cod.tracker.gg profile overview: lots of unrelated markup with the
+    "Last 7 Days" section somewhere in the middle
+    """
+    filler_section = (
+        '<div class="segment"><div class="title"><h2>Lifetime</h2></div><div class="stats">'
+        + "".join(_build_stat_block(f"Stat {idx}", str(idx)) for idx in range(12))
+        + "</div></div>"
+    )
+    l7d_section = (
+        '<div class="segment"><h2>Last 7 Days</h2><div class="stats">'
+        + _build_stat_block("Wins", "3")
+        + _build_stat_block("K/D Ratio", str(kd))
+        + _build_stat_block("Kills", "150")
+        + "</div></div>"
+    )
+    half = num_filler_sections // 2
+    return (
+        "<html><head><title>Profile</title></head><body>"
+        + filler_section * half
+        + l7d_section
+        + filler_section * (num_filler_sections - half)
+        + "</body></html>"
+    )
@@ -4,6 +4,69 @@ from models.player import Player
 
 MAX_CALLS = 5
 
+# Shared HTTP transport for tracker.gg
+HTTP_POOL_SIZE = 16
+HTTP_CONNECT_TIMEOUT_SEC = 5
+HTTP_READ_TIMEOUT_SEC = 30
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE_SEC = 1
+HTTP_BACKOFF_MAX_SEC = 30
+HTTP_DEFAULT_ENDPOINT_CONCURRENCY = 4
+HTTP_ENDPOINT_CONCURRENCY = {
+    "match_ids": 4,
+    "match": 8,
+    "search": 4,
+    "profile": 4,
+}
+
+# Pacing for the enemy stats workflow, which makes ~3 tracker.gg requests per player in a lobby
+ENEMY_STATS_REQUESTS_PER_SECOND = 4.0
+ENEMY_STATS_REQUEST_BURST = 8
+ENEMY_STATS_MAX_WORKERS = 8
+ENEMY_STATS_PARSE_PROCESSES = 4
+# Offline enemy stats rate players from their appearances in locally stored lobbies over this window
+OFFLINE_ENEMY_LOOKBACK_SEC = 30 * 24 * 60 * 60
+OFFLINE_ENEMY_MIN_APPEARANCES = 3
+
+# Concurrency for pulling a team's match history
+TEAM_INGEST_MAX_WORKERS = 8
+# Backfills walk each player's whole match history, so they're paced well below the interactive workflows
+BACKFILL_REQUESTS_PER_SECOND = 2.0
+BACKFILL_REQUEST_BURST = 4
+BACKFILL_MAX_WORKERS = 4
+# Downloaded matches are written to the match store in transactions of this many
+BACKFILL_STORE_BATCH_SIZE = 100
+
+# How often daemon mode checks every roster player for new matches
+DAEMON_POLL_INTERVAL_SEC = 5 * 60
+
+# Validate match payloads with the marshmallow schema instead of the fast decoder
+STRICT_MATCH_VALIDATION = False
+
+# Local SQLite database of every match downloaded from tracker.gg
+MATCH_STORE_PATH = "warzone_matches.db"
+
+# Local SQLite copy of the rows written to the sheets, for querying match history
+ANALYTICS_STORE_PATH = "warzone_analytics.db"
+
+# Running per player / roster / mode aggregates written to each team's Summary tab
+ROLLING_STATS_PATH = "rolling_stats.json"
+ROLLING_STATS_WINDOW = 20
+
+# Persistent cache of gamertag -> Activision ID resolutions and last 7 day K/D scrapes
+LOOKUP_CACHE_PATH = "lookup_cache.jsonl"
+LOOKUP_CACHE_MAX_ENTRIES = 50000
+ACTIVISION_ID_TTL_SEC = 90 * 24 * 60 * 60
+L7D_KD_TTL_SEC = 4 * 60 * 60
+NEGATIVE_LOOKUP_TTL_SEC = 30 * 60
+
+# Google Sheets REST API. Point SHEETS_API_BASE_URL at a local fake server to run without Google credentials
+SHEETS_API_BASE_URL = "https://sheets.googleapis.com/"
+SHEETS_HTTP_POOL_SIZE = 4
+SHEETS_TOKEN_PATH = "token.json"
+SHEETS_LEGACY_TOKEN_PATH = "token.pickle"
+SHEETS_CLIENT_SECRETS_PATH = "credentials.json"
+
 BRIAN = Player(activision_id="8226586", name="Brian", display_name="Harmuny")
 JUSTIN = Player(activision_id="2716959", name="Justin", display_name="jsquared8")
 MAHITH = Player(activision_id="4702806", name="Mahith", display_name="x Pr1mal Fear x")
@@ -13,12 +76,6 @@ RAVI = Player(activision_id="3102549", name="Ravi", display_name="rdykl")
 VINNY = Player(activision_id="9821768", name="Vinny", display_name="TheCastleDaddy")
 
 TIME_FORMAT = "%m/%d/%Y %H:%M"
-INDIVIDUAL_PLAYER_ROW_FORMAT = (
-    "{match_id},{time},{placement},{kills},{deaths},{dmg_done},{gulag_kills},{gulag_deaths},{roster},{mode}"
-)
-TEAM_ROW_FORMAT = (
-    "{match_id},{time},{game_duration},{placement},{kills},{deaths},{dmg_done},{roster},{mode},{win},{top_five}"
-)
 
 
 GAMERTAG_TO_NAME_MAP = {
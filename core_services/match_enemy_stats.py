@@ -1,37 +1,88 @@
-import operator
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor
 from statistics import pstdev, quantiles
-from time import sleep
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 
+from constants import (
+    ENEMY_STATS_REQUESTS_PER_SECOND,
+    ENEMY_STATS_REQUEST_BURST,
+    ENEMY_STATS_MAX_WORKERS,
+    ENEMY_STATS_PARSE_PROCESSES,
+    OFFLINE_ENEMY_LOOKBACK_SEC,
+    OFFLINE_ENEMY_MIN_APPEARANCES,
+)
 from external_services.cod_tracker_scraper import CodTrackerScraper
+from external_services.http_transport import HttpTransport
+from models.external_models.compact_cod_tracker_models import CompactWarzoneMatch
+from models.enemy_stats_report import EnemyStatsReport, EnemyStatsSessionReport
 from models.player import Player
+from utils.instrumentation import timer, timed
+from utils.rate_limiter import TokenBucketRateLimiter
 
 
 class MatchEnemyStats:
-    def __init__(self):
-        self.scraper = CodTrackerScraper()
-        self.total_players_in_match = 0
-        self.skipped_players = 0
-        self.warzone_match_data = None
-
-    def display_stats_for_enemies_in_match(self, match_id: str) -> None:
-        team_avg_kd, player_to_kd_dict = self.pull_stats_for_enemies_in_match(match_id)
+    def __init__(
+        self,
+        requests_per_second: float = ENEMY_STATS_REQUESTS_PER_SECOND,
+        request_burst: int = ENEMY_STATS_REQUEST_BURST,
+        max_workers: int = ENEMY_STATS_MAX_WORKERS,
+        parse_processes: int = ENEMY_STATS_PARSE_PROCESSES,
+        scraper: Optional[CodTrackerScraper] = None,
+    ):
+        if scraper is None:
+            rate_limiter = TokenBucketRateLimiter(requests_per_second, request_burst)
+            scraper = CodTrackerScraper(transport=HttpTransport(rate_limiter=rate_limiter))
+        self.scraper = scraper
+        self.max_workers = max_workers
+        self.parse_processes = parse_processes
+        # Started on the first lookup and reused until close()
+        self._parse_executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_parse_executor(self) -> ProcessPoolExecutor:
+        if self._parse_executor is None:
+            # Forking a process that already runs HTTP and thread pools can copy held locks into the children, so
+            # workers are spawned fresh instead
+            self._parse_executor = ProcessPoolExecutor(
+                max_workers=self.parse_processes, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._parse_executor
+
+    def close(self) -> None:
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown()
+            self._parse_executor = None
+
+    def display_stats_for_enemies_in_match(self, match_id: str, offline: bool = False) -> None:
+        self.display_stats_for_enemies_in_matches([match_id], offline)
+
+    def display_stats_for_enemies_in_matches(self, match_ids: List[str], offline: bool = False) -> None:
+        session_report = self.pull_stats_for_enemies_in_matches(match_ids, offline)
+        for report in session_report.match_reports:
+            self._display_match_report(report)
+        if len(session_report.match_reports) > 1:
+            self._display_session_report(session_report)
+        self.scraper.lookup_cache.print_stats()
+
+    def _display_match_report(self, report: EnemyStatsReport) -> None:
+        team_avg_kd, player_to_kd_dict = report.team_avg_kd, report.player_kds
         if not team_avg_kd or not player_to_kd_dict:
+            print(f"\nNo player data for match {report.match_id}")
             return
-        all_player_kd = player_to_kd_dict.values()
+        all_player_kd = list(player_to_kd_dict.values())
         min_kd_in_match = min(all_player_kd)
         max_kd_in_match = max(all_player_kd)
         best_player = max(player_to_kd_dict, key=lambda x: player_to_kd_dict[x])
         avg_kd_in_match = round(sum(all_player_kd) / len(all_player_kd), 2)
         std_dev_of_indiv_kd = round(pstdev(all_player_kd), 4)
-        quantiles_breakdown = quantiles(all_player_kd, method="inclusive")
+        quantiles_breakdown = quantiles(all_player_kd, method="inclusive") if len(all_player_kd) > 1 else [None] * 3
         avg_kd_of_teams = round(sum(team_avg_kd) / len(team_avg_kd), 2)
         kd_top_15 = team_avg_kd[:15]
 
         print(
             f"""
-Match {match_id} Player Stats
-There is data for {self.total_players_in_match - self.skipped_players}/{self.total_players_in_match} players
+Match {report.match_id} Player Stats
+There is data for {report.total_players - report.skipped_players}/{report.total_players} players
 The average K/D for all players is {avg_kd_in_match} and the standard deviation is {std_dev_of_indiv_kd}
 The lowest K/D is {min_kd_in_match}
 25% Percentile: {quantiles_breakdown[0]}
@@ -39,39 +90,140 @@ The lowest K/D is {min_kd_in_match}
 75% Percentile: {quantiles_breakdown[2]}
 The best K/D is {max_kd_in_match} ({best_player})
 
-There is data for {len(team_avg_kd)} teams (Expected {self.warzone_match_data.metadata.team_count} teams)
+There is data for {len(team_avg_kd)} teams (Expected {report.team_count} teams)
 The average K/D of all teams is {avg_kd_of_teams}
               """
         )
         for idx, top_15_team in enumerate(kd_top_15):
             print(f"Team #{idx + 1}'s K/D is {top_15_team}")
 
-    def pull_stats_for_enemies_in_match(self, match_id: str) -> Tuple[List[float], Dict[str, float]]:
-        self.warzone_match_data = self.scraper.get_all_data_for_match(match_id)
-        if not self.warzone_match_data:
-            return [], {}
-        team_array = [[] for i in range(self.warzone_match_data.metadata.team_count)]
-        team_avg_kd = []
-        all_player_kds = {}
-        for wz_player in self.warzone_match_data.players:
-            sleep(3)
-            self.total_players_in_match += 1
-            activision_id, platform = self.scraper.get_activision_id_for_gamertag(wz_player.gamertag)
-            if activision_id is None:
-                self.skipped_players += 1
-                continue
-            player = Player(activision_id=activision_id, platform=platform, display_name=wz_player.gamertag, name="")
-            player_kd = self.scraper.get_last_7d_kd_ratio_for_player(player)
+    def _display_session_report(self, session_report: EnemyStatsSessionReport) -> None:
+        lobby_kds = {
+            report.match_id: round(sum(report.player_kds.values()) / len(report.player_kds), 2)
+            for report in session_report.match_reports
+            if report.player_kds
+        }
+        print(f"\nSession summary for {len(session_report.match_reports)} matches")
+        print(
+            f"{session_report.distinct_players} distinct players, "
+            f"{session_report.repeat_players} of them in more than one lobby"
+        )
+        if not lobby_kds:
+            return
+        print(f"The average lobby K/D was {round(sum(lobby_kds.values()) / len(lobby_kds), 2)}")
+        for match_id, lobby_kd in sorted(lobby_kds.items(), key=lambda item: item[1], reverse=True):
+            print(f"Match {match_id}: average K/D {lobby_kd}")
+
+    def _get_kd_for_gamertag(self, gamertag: str, parse_executor: Optional[Executor] = None) -> Optional[float]:
+        activision_id, platform = self.scraper.get_activision_id_for_gamertag(gamertag)
+        if activision_id is None:
+            return None
+        player = Player(activision_id=activision_id, platform=platform, display_name=gamertag, name="")
+        return self.scraper.get_last_7d_kd_ratio_for_player(player, parse_executor)
+
+    @timed("enemies.look_up_kds")
+    def _look_up_kds(self, gamertags: List[str]) -> List[Optional[float]]:
+        if not gamertags:
+            return []
+        # Profile pages are parsed on a process pool so parse CPU doesn't serialize behind the network
+        parse_executor = self._get_parse_executor()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda gamertag: self._get_kd_for_gamertag(gamertag, parse_executor), gamertags))
+
+    @timed("enemies.offline_estimates")
+    def _estimate_kds_from_match_history(self, warzone_match_data: CompactWarzoneMatch) -> Dict[str, float]:
+        """
+        Rates players by their kills and deaths across other lobbies in the local match store, for players with
+        enough recent appearances
+        """
+        metadata = warzone_match_data.metadata
+        totals = self.scraper.match_store.get_player_kill_death_totals(
+            list(set(warzone_match_data.players.gamertags)),
+            exclude_match_id=metadata.match_id,
+            since_ts=metadata.start_time_ts - OFFLINE_ENEMY_LOOKBACK_SEC,
+        )
+        return {
+            gamertag: round(kills / max(deaths, 1), 2)
+            for gamertag, (kills, deaths, num_matches) in totals.items()
+            if num_matches >= OFFLINE_ENEMY_MIN_APPEARANCES
+        }
+
+    @staticmethod
+    def _build_match_report(
+        warzone_match_data: CompactWarzoneMatch, player_kds: Dict[str, Optional[float]]
+    ) -> EnemyStatsReport:
+        lobby = warzone_match_data.players
+        report = EnemyStatsReport(
+            match_id=warzone_match_data.metadata.match_id, team_count=warzone_match_data.metadata.team_count
+        )
+        kds_by_team: Dict[int, List[float]] = {}
+        for gamertag, team_placement in zip(lobby.gamertags, lobby.team_placement):
+            report.total_players += 1
+            player_kd = player_kds.get(gamertag)
             if not player_kd:
-                self.skipped_players += 1
+                report.skipped_players += 1
                 continue
-            all_player_kds[wz_player.gamertag] = player_kd
-            team_array[wz_player.stats.team_placement - 1].append(player_kd)
+            report.player_kds[gamertag] = player_kd
+            kds_by_team.setdefault(team_placement, []).append(player_kd)
 
-        for team in team_array:
-            if not team:
-                continue
+        for team_placement in sorted(kds_by_team):
+            team = kds_by_team[team_placement]
             average_kd_of_team = round(sum(team) / len(team), 2)
-            team_avg_kd.append(average_kd_of_team)
+            report.team_avg_kd.append(average_kd_of_team)
+        return report
+
+    def pull_stats_for_enemies_in_matches(self, match_ids: List[str], offline: bool = False) -> EnemyStatsSessionReport:
+        """
+        Builds a report for every match in a session. Players who appear in several of the lobbies are only
+        looked up once
+        :param match_ids:
+        :param offline: Estimate K/Ds from matches already in the local match store, only going to the network for
+        players without enough stored appearances
+        :return:
+        """
+        matches = []
+        with timer("enemies.fetch_lobbies"):
+            for match_id in dict.fromkeys(match_ids):
+                warzone_match_data = self.scraper.get_all_compact_data_for_match(match_id)
+                if warzone_match_data:
+                    matches.append(warzone_match_data)
 
-        return team_avg_kd, all_player_kds
+        # Offline estimates exclude the lobby being rated, so they are kept per match
+        estimated_kds_by_match = {
+            m.metadata.match_id: self._estimate_kds_from_match_history(m) if offline else {} for m in matches
+        }
+        appearances = Counter(gamertag for m in matches for gamertag in set(m.players.gamertags))
+        gamertags_to_look_up = list(
+            dict.fromkeys(
+                gamertag
+                for m in matches
+                for gamertag in m.players.gamertags
+                if gamertag not in estimated_kds_by_match[m.metadata.match_id]
+            )
+        )
+        if offline:
+            print(f"{len(appearances) - len(gamertags_to_look_up)}/{len(appearances)} players rated offline")
+        looked_up_kds = dict(zip(gamertags_to_look_up, self._look_up_kds(gamertags_to_look_up)))
+
+        with timer("enemies.build_reports"):
+            match_reports = [
+                self._build_match_report(m, {**looked_up_kds, **estimated_kds_by_match[m.metadata.match_id]})
+                for m in matches
+            ]
+        return EnemyStatsSessionReport(
+            match_reports=match_reports,
+            distinct_players=len(appearances),
+            repeat_players=sum(1 for count in appearances.values() if count > 1),
+        )
+
+    def pull_stats_for_enemies_in_match(
+        self, match_id: str, offline: bool = False
+    ) -> Tuple[List[float], Dict[str, float]]:
+        """
+        :return: The average K/D of each team ordered by placement, and each player's K/D
+        """
+        session_report = self.pull_stats_for_enemies_in_matches([match_id], offline)
+        if not session_report.match_reports:
+            return [], {}
+        report = session_report.match_reports[0]
+        return report.team_avg_kd, report.player_kds
@@ -0,0 +1,174 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional, Tuple, Any
+
+from constants import (
+    TEAM_ROSTERS,
+    BACKFILL_REQUESTS_PER_SECOND,
+    BACKFILL_REQUEST_BURST,
+    BACKFILL_MAX_WORKERS,
+    BACKFILL_STORE_BATCH_SIZE,
+)
+from external_services.cod_tracker_scraper import CodTrackerScraper
+from external_services.http_transport import HttpTransport
+from models.player import Player
+from utils.instrumentation import count, timer, timed
+from utils.rate_limiter import TokenBucketRateLimiter
+
+
+class MatchHistoryBackfill:
+    """
+    Walks players' whole match history into the local match store, past the window a normal run paginates through.
+    Every page of match IDs is checkpointed in the store together with the token for the next page, so an
+    interrupted backfill resumes where it stopped, and matches that are already stored are never fetched again
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = BACKFILL_REQUESTS_PER_SECOND,
+        request_burst: int = BACKFILL_REQUEST_BURST,
+        max_workers: int = BACKFILL_MAX_WORKERS,
+        max_pages: Optional[int] = None,
+        store_batch_size: int = BACKFILL_STORE_BATCH_SIZE,
+        scraper: Optional[CodTrackerScraper] = None,
+    ):
+        """
+        :param max_pages: Pages of match IDs to walk per player in this run (default: the whole history). The next
+        run carries on from there
+        """
+        if scraper is None:
+            rate_limiter = TokenBucketRateLimiter(requests_per_second, request_burst)
+            scraper = CodTrackerScraper(transport=HttpTransport(rate_limiter=rate_limiter))
+        self.scraper = scraper
+        self.match_store = scraper.match_store
+        self.max_workers = max_workers
+        self.max_pages = max_pages
+        self.store_batch_size = store_batch_size
+        # Downloaded matches waiting to be written to the match store in one transaction
+        self._pending_matches: List[Tuple[str, Dict[str, Any]]] = []
+        self._pending_matches_lock = threading.Lock()
+        self._fetch_futures_lock = threading.Lock()
+
+    @staticmethod
+    def get_player_key(player: Player) -> str:
+        return f"{player.platform}/{player.get_urlencoded_activision_username()}"
+
+    def _flush_pending_matches(self, min_batch_size: int = 1) -> int:
+        with self._pending_matches_lock:
+            if len(self._pending_matches) < min_batch_size:
+                return 0
+            batch, self._pending_matches = self._pending_matches, []
+        with timer("store.put_matches"):
+            self.match_store.put_matches(batch)
+        count("backfill_matches_stored", amount=len(batch))
+        return len(batch)
+
+    def _fetch_match(self, match_id: str, player: Player) -> bool:
+        try:
+            raw_match_data = self.scraper.fetch_raw_match_data(match_id, player)
+        except Exception as e:
+            # The match ID is still checkpointed, so the next run picks it up again
+            print(f"Fetching data for match {match_id} failed with {str(e)}")
+            return False
+        with self._pending_matches_lock:
+            self._pending_matches.append((match_id, raw_match_data))
+        self._flush_pending_matches(self.store_batch_size)
+        return True
+
+    def _paginate(self, player: Player, fetch_executor: ThreadPoolExecutor, fetch_futures: Dict[str, Future]) -> None:
+        """
+        Walks a player's history from their checkpoint, submitting every match that isn't stored yet for download
+        as each page arrives
+        """
+        player_key = self.get_player_key(player)
+        progress = self.match_store.get_backfill_progress(player_key)
+        next_token, pages_fetched, completed = progress if progress else (None, 0, False)
+        if progress:
+            # Matches found before a restart that never made it into the store
+            self._submit_missing(
+                [match_id for match_id, _ in self.match_store.get_backfill_match_ids(player_key)],
+                player,
+                fetch_executor,
+                fetch_futures,
+            )
+        if completed:
+            print(f"Match history for {player.name} is already backfilled ({pages_fetched} pages)")
+            return
+
+        pages_this_run = 0
+        while self.max_pages is None or pages_this_run < self.max_pages:
+            try:
+                matches, next_token = self.scraper.fetch_match_page_for_player(player, next_token)
+            except Exception as e:
+                print(f"Backfill for {player.name} stopped at page {pages_fetched + 1}, it resumes from there next run")
+                print(str(e))
+                return
+            pages_this_run += 1
+            pages_fetched += 1
+            completed = next_token is None
+            self.match_store.save_backfill_page(player_key, matches, next_token, pages_fetched, completed)
+            count("backfill_pages")
+            self._submit_missing([match_id for match_id, _ in matches], player, fetch_executor, fetch_futures)
+            if completed:
+                print(f"Reached the start of {player.name}'s match history after {pages_fetched} pages")
+                return
+        print(f"Walked {pages_fetched} pages of {player.name}'s match history so far")
+
+    def _submit_missing(
+        self, match_ids: List[str], player: Player, fetch_executor: ThreadPoolExecutor, fetch_futures: Dict[str, Future]
+    ) -> None:
+        # Squadmates share most of their matches, so each distinct match is only submitted once
+        for match_id in self.match_store.get_missing_match_ids(match_ids):
+            with self._fetch_futures_lock:
+                if match_id in fetch_futures:
+                    continue
+                fetch_futures[match_id] = fetch_executor.submit(self._fetch_match, match_id, player)
+
+    @timed("backfill.players")
+    def backfill_players(self, players: List[Player]) -> int:
+        """
+        :param players:
+        :return: How many matches were newly stored
+        """
+        fetch_futures: Dict[str, Future] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as fetch_executor:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(players), self.max_workers))) as page_executor:
+                list(page_executor.map(lambda player: self._paginate(player, fetch_executor, fetch_futures), players))
+        self._flush_pending_matches()
+        num_stored = sum(future.result() for future in fetch_futures.values())
+        print(f"Stored {num_stored}/{len(fetch_futures)} new matches")
+        return num_stored
+
+    def restart_players(self, players: List[Player]) -> None:
+        """
+        Forgets the players' checkpoints so the next backfill walks their history from the most recent match again.
+        Stored matches are kept, so they still aren't fetched again
+        """
+        for player in players:
+            self.match_store.clear_backfill_progress(self.get_player_key(player))
+
+    def write_backfilled_matches_to_sheets(self, teams: List[str]) -> int:
+        """
+        Adds every backfilled match older than the team sheets' first rows to the sheets, in chronological order
+        :return: How many rows were written
+        """
+        from core_services.team_data_aggregator import TeamDataAggregator
+
+        aggregator = TeamDataAggregator(scraper=self.scraper)
+        num_rows = 0
+        for team in teams:
+            backfilled_matches_by_player = {
+                player.name: self.match_store.get_backfill_match_ids(self.get_player_key(player))
+                for player in TEAM_ROSTERS[team]
+            }
+            num_rows += aggregator.write_backfilled_matches_for_team(team, backfilled_matches_by_player)
+        return num_rows
+
+    def backfill_teams(self, teams: List[str], restart: bool = False, write_sheets: bool = False) -> int:
+        players = list({player.name: player for team in teams for player in TEAM_ROSTERS[team]}.values())
+        if restart:
+            self.restart_players(players)
+        num_stored = self.backfill_players(players)
+        if write_sheets:
+            self.write_backfilled_matches_to_sheets(teams)
+        return num_stored
@@ -0,0 +1,221 @@
+import json
+import os.path
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Tuple, Optional, Deque, Set, Union
+
+from constants import ROLLING_STATS_PATH, ROLLING_STATS_WINDOW
+from core_services.row_builder import RowBuilder, AnyWarzoneMatch
+
+PLAYER_SCOPE = "player"
+ROSTER_SCOPE = "roster"
+MODE_SCOPE = "mode"
+# Mode stats are keyed "<team>/<mode name>" so each team's games are counted separately
+MODE_KEY_SEPARATOR = "/"
+
+SUMMARY_HEADER = [
+    "scope",
+    "key",
+    "games",
+    "kd",
+    f"last_{ROLLING_STATS_WINDOW}_kd",
+    f"last_{ROLLING_STATS_WINDOW}_avg_dmg",
+    "win_rate",
+    "top_five_rate",
+    "win_streak",
+    "longest_win_streak",
+    "top_five_streak",
+]
+
+
+@dataclass
+class RollingStat:
+    """
+    Running totals, a fixed-size window of recent games and streak counters for one player, roster or mode.
+    Every update is O(1): window sums are adjusted by the game entering and the game falling out of the window
+    """
+
+    games: int = 0
+    kills: int = 0
+    deaths: int = 0
+    damage_done: int = 0
+    wins: int = 0
+    top_fives: int = 0
+    win_streak: int = 0
+    longest_win_streak: int = 0
+    top_five_streak: int = 0
+    window_kills: int = 0
+    window_deaths: int = 0
+    window_damage_done: int = 0
+    # (kills, deaths, damage_done) of the most recent games, oldest first
+    window: Deque[Tuple[int, int, int]] = field(default_factory=lambda: deque(maxlen=ROLLING_STATS_WINDOW))
+    last_match_id: Optional[str] = None
+    last_start_ts: Optional[int] = None
+
+    def update(self, match_id: str, start_ts: int, kills: int, deaths: int, damage_done: int, placement: int) -> bool:
+        """
+        Adds one game. Games that aren't newer than the last one ingested are ignored, so re-running over the same
+        matches doesn't double count
+        :return: Whether the game was counted
+        """
+        if match_id == self.last_match_id or (self.last_start_ts is not None and start_ts < self.last_start_ts):
+            return False
+        self.last_match_id = match_id
+        self.last_start_ts = start_ts
+
+        self.games += 1
+        self.kills += kills
+        self.deaths += deaths
+        self.damage_done += damage_done
+
+        won = placement == 1
+        # A missing placement is None or 0, depending on the decoder
+        top_five = placement is not None and 0 < placement <= 5
+        self.wins += won
+        self.top_fives += top_five
+        self.win_streak = self.win_streak + 1 if won else 0
+        self.longest_win_streak = max(self.longest_win_streak, self.win_streak)
+        self.top_five_streak = self.top_five_streak + 1 if top_five else 0
+
+        if len(self.window) == self.window.maxlen:
+            old_kills, old_deaths, old_damage_done = self.window[0]
+            self.window_kills -= old_kills
+            self.window_deaths -= old_deaths
+            self.window_damage_done -= old_damage_done
+        self.window.append((kills, deaths, damage_done))
+        self.window_kills += kills
+        self.window_deaths += deaths
+        self.window_damage_done += damage_done
+        return True
+
+    def to_summary_row(self, scope: str, key: str) -> List[Union[str, int, float]]:
+        return [
+            scope,
+            key,
+            self.games,
+            round(self.kills / max(self.deaths, 1), 2),
+            round(self.window_kills / max(self.window_deaths, 1), 2),
+            round(self.window_damage_done / len(self.window)) if self.window else 0,
+            round(self.wins / self.games, 4) if self.games else 0,
+            round(self.top_fives / self.games, 4) if self.games else 0,
+            self.win_streak,
+            self.longest_win_streak,
+            self.top_five_streak,
+        ]
+
+    def to_json(self) -> Dict:
+        data = asdict(self)
+        data["window"] = [list(game) for game in self.window]
+        return data
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "RollingStat":
+        window = data.pop("window", [])
+        stat = cls(**data)
+        stat.window.extend(tuple(game) for game in window)
+        return stat
+
+
+class RollingStatsEngine:
+    """
+    Keeps RollingStats per player (individual stats), per roster and per team and mode (team totals), persisted
+    between runs. Matches are staged as rows are built and applied in chronological order once per run
+    """
+
+    def __init__(self, path: str = ROLLING_STATS_PATH, row_builder: Optional[RowBuilder] = None):
+        self.path = path
+        self.row_builder = row_builder if row_builder else RowBuilder()
+        self.stats: Dict[Tuple[str, str], RollingStat] = {}
+        self._pending_player_matches: Dict[Tuple[str, str], Tuple[str, AnyWarzoneMatch]] = {}
+        # match_id -> teams whose mode stats the match counts towards
+        self._pending_match_teams: Dict[str, Set[str]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as stats_file:
+            saved_stats = json.load(stats_file)
+        for saved_stat in saved_stats:
+            stat_key = (saved_stat.pop("scope"), saved_stat.pop("key"))
+            if stat_key[0] == MODE_SCOPE and MODE_KEY_SEPARATOR not in stat_key[1]:
+                # Mode stats used to be shared by every team, which mixed their games together, so they're dropped
+                continue
+            self.stats[stat_key] = RollingStat.from_json(saved_stat)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        saved_stats = [
+            {"scope": scope, "key": key, **stat.to_json()} for (scope, key), stat in sorted(self.stats.items())
+        ]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as stats_file:
+            json.dump(saved_stats, stats_file)
+        os.replace(tmp_path, self.path)
+
+    def _get_stat(self, scope: str, key: str) -> RollingStat:
+        if (scope, key) not in self.stats:
+            self.stats[(scope, key)] = RollingStat()
+        return self.stats[(scope, key)]
+
+    @staticmethod
+    def _get_mode_key(team: str, mode_name: str) -> str:
+        return f"{team}{MODE_KEY_SEPARATOR}{mode_name}"
+
+    def stage_player_matches(self, team: str, player_name: str, gamertag: str, matches: List[AnyWarzoneMatch]) -> None:
+        for warzone_match_data in matches:
+            match_id = warzone_match_data.metadata.match_id
+            self._pending_player_matches[(player_name, match_id)] = (gamertag, warzone_match_data)
+            self._pending_match_teams.setdefault(match_id, set()).add(team)
+
+    def apply_staged_matches(self) -> None:
+        """
+        Applies every staged (player, match) pair oldest first. Roster stats are updated once per match and mode
+        stats once per match for each team it was staged for
+        """
+        staged = sorted(self._pending_player_matches.items(), key=lambda item: item[1][1].metadata.start_time_ts)
+        applied_team_matches: Set[str] = set()
+        for (player_name, match_id), (gamertag, warzone_match_data) in staged:
+            metadata = warzone_match_data.metadata
+            warzone_player = next((p for p in warzone_match_data.players if p.gamertag == gamertag), None)
+            if warzone_player:
+                stats = warzone_player.stats
+                self._get_stat(PLAYER_SCOPE, player_name).update(
+                    match_id, metadata.start_time_ts, stats.kills, stats.deaths, stats.damage_done, stats.team_placement
+                )
+            if match_id in applied_team_matches:
+                continue
+            applied_team_matches.add(match_id)
+            kills, deaths, damage_done, _, team_placement = self.row_builder.get_team_totals(warzone_match_data)
+            roster = "|".join(self.row_builder.get_team_roster(warzone_match_data))
+            stat_keys = [(ROSTER_SCOPE, roster)] + [
+                (MODE_SCOPE, self._get_mode_key(team, metadata.mode_name))
+                for team in sorted(self._pending_match_teams.get(match_id, ()))
+            ]
+            for scope, key in stat_keys:
+                self._get_stat(scope, key).update(
+                    match_id, metadata.start_time_ts, kills, deaths, damage_done, team_placement
+                )
+        self._pending_player_matches = {}
+        self._pending_match_teams = {}
+        self.save()
+
+    def get_summary_rows(self, team: str, player_names: List[str]) -> List[List[Union[str, int, float]]]:
+        """
+        Summary rows for the given players, every roster with at least two of them, and every mode the team played
+        """
+        player_name_set = set(player_names)
+        mode_key_prefix = self._get_mode_key(team, "")
+        rows = [SUMMARY_HEADER]
+        for (scope, key), stat in sorted(self.stats.items()):
+            if scope == PLAYER_SCOPE and key not in player_name_set:
+                continue
+            if scope == ROSTER_SCOPE and len(set(key.split("|")) & player_name_set) < 2:
+                continue
+            if scope == MODE_SCOPE:
+                if not key.startswith(mode_key_prefix):
+                    continue
+                key = key[len(mode_key_prefix) :]
+            rows.append(stat.to_summary_row(scope, key))
+        return rows
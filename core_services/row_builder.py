@@ -0,0 +1,148 @@
+from datetime import datetime
+from typing import List, Dict, Union, Iterable, Optional, Tuple
+
+from constants import TIME_FORMAT, GAMERTAG_TO_NAME_MAP
+from models.external_models.cod_tracker_models import WarzoneMatch
+from models.external_models.compact_cod_tracker_models import CompactWarzoneMatch, MISSING_PLACEMENT
+
+AnyWarzoneMatch = Union[WarzoneMatch, CompactWarzoneMatch]
+SheetRow = List[Union[str, int]]
+
+# Column order of the rows written to each player's sheet and to the "Overall" sheet
+INDIVIDUAL_PLAYER_ROW_COLUMNS = (
+    "match_id",
+    "time",
+    "placement",
+    "kills",
+    "deaths",
+    "dmg_done",
+    "gulag_kills",
+    "gulag_deaths",
+    "roster",
+    "mode",
+)
+TEAM_ROW_COLUMNS = (
+    "match_id",
+    "time",
+    "game_duration",
+    "placement",
+    "kills",
+    "deaths",
+    "dmg_done",
+    "roster",
+    "mode",
+    "win",
+    "top_five",
+)
+
+
+class RowBuilder:
+    """
+    Builds typed sheet rows for batches of matches. Each match's roster and formatted start time are computed once
+    and memoized by match_id, and team totals are taken in a single pass over the players (or straight from the
+    stat columns of a CompactWarzoneMatch)
+    """
+
+    def __init__(self):
+        self._roster_cache: Dict[str, List[str]] = {}
+        self._formatted_time_cache: Dict[str, str] = {}
+
+    def get_team_roster(self, warzone_match_data: AnyWarzoneMatch) -> List[str]:
+        match_id = warzone_match_data.metadata.match_id
+        roster = self._roster_cache.get(match_id)
+        if roster is None:
+            gamertags = (
+                warzone_match_data.players.gamertags
+                if isinstance(warzone_match_data, CompactWarzoneMatch)
+                else [p.gamertag for p in warzone_match_data.players]
+            )
+            roster = sorted(set(GAMERTAG_TO_NAME_MAP.get(gamertag, "Random") for gamertag in gamertags))
+            self._roster_cache[match_id] = roster
+        return roster
+
+    def get_formatted_time(self, warzone_match_data: AnyWarzoneMatch) -> str:
+        match_id = warzone_match_data.metadata.match_id
+        formatted_time = self._formatted_time_cache.get(match_id)
+        if formatted_time is None:
+            utc_dt = datetime.utcfromtimestamp(warzone_match_data.metadata.start_time_ts)
+            formatted_time = utc_dt.strftime(TIME_FORMAT)
+            self._formatted_time_cache[match_id] = formatted_time
+        return formatted_time
+
+    @staticmethod
+    def get_team_totals(warzone_match_data: AnyWarzoneMatch) -> Tuple[int, int, int, int, Optional[int]]:
+        """
+        :return: (kills, deaths, damage done, game length, team placement) for the players in the match
+        """
+        players = warzone_match_data.players
+        if isinstance(warzone_match_data, CompactWarzoneMatch):
+            team_placement = players.team_placement[0] if len(players) else MISSING_PLACEMENT
+            return (
+                sum(players.kills),
+                sum(players.deaths),
+                sum(players.damage_done),
+                max(players.time_played_sec, default=0),
+                None if team_placement == MISSING_PLACEMENT else team_placement,
+            )
+
+        kills = deaths = damage_done = game_length = 0
+        for player in players:
+            stats = player.stats
+            kills += stats.kills
+            deaths += stats.deaths
+            damage_done += stats.damage_done
+            if stats.time_played_sec > game_length:
+                game_length = stats.time_played_sec
+        team_placement = players[0].stats.team_placement if players else None
+        return kills, deaths, damage_done, game_length, team_placement
+
+    def build_team_rows(self, matches: Iterable[AnyWarzoneMatch]) -> List[SheetRow]:
+        """
+        Builds one "Overall" row per match, in the order given. See TEAM_ROW_COLUMNS
+        """
+        rows = []
+        for warzone_match_data in matches:
+            kills, deaths, damage_done, game_length, team_placement = self.get_team_totals(warzone_match_data)
+            rows.append(
+                [
+                    warzone_match_data.metadata.match_id,
+                    self.get_formatted_time(warzone_match_data),
+                    game_length,
+                    team_placement,
+                    kills,
+                    deaths,
+                    damage_done,
+                    "|".join(self.get_team_roster(warzone_match_data)),
+                    warzone_match_data.metadata.mode_name,
+                    1 if team_placement == 1 else 0,
+                    1 if team_placement is not None and 0 < team_placement <= 5 else 0,
+                ]
+            )
+        return rows
+
+    def build_individual_rows(self, gamertag: str, matches: Iterable[AnyWarzoneMatch]) -> List[SheetRow]:
+        """
+        Builds one row per match for the player with the given gamertag, in the order given. Matches the player
+        isn't in are skipped. See INDIVIDUAL_PLAYER_ROW_COLUMNS
+        """
+        rows = []
+        for warzone_match_data in matches:
+            warzone_player = next((p for p in warzone_match_data.players if p.gamertag == gamertag), None)
+            if warzone_player is None:
+                continue
+            stats = warzone_player.stats
+            rows.append(
+                [
+                    warzone_match_data.metadata.match_id,
+                    self.get_formatted_time(warzone_match_data),
+                    stats.team_placement,
+                    stats.kills,
+                    stats.deaths,
+                    stats.damage_done,
+                    stats.gulag_kills,
+                    stats.gulag_deaths,
+                    "|".join(self.get_team_roster(warzone_match_data)),
+                    warzone_match_data.metadata.mode_name,
+                ]
+            )
+        return rows
@@ -0,0 +1,114 @@
+from time import monotonic, sleep
+from typing import List, Dict, Optional, Tuple
+
+from constants import TEAM_ROSTERS, DAEMON_POLL_INTERVAL_SEC
+from core_services.team_data_aggregator import TeamDataAggregator
+from external_services.cod_tracker_scraper import CodTrackerScraper
+from external_services.google_sheets_api import GoogleSheetsApi
+from models.player import Player
+from utils.instrumentation import count, timer, timed
+
+
+class SyncDaemon:
+    """
+    Keeps team sheets close to real time by polling. Each poll makes one conditional request per roster player for
+    their newest match and compares it with the newest match already synced for each team. A normal incremental run
+    only happens for teams where someone has played since, so each sync writes a small batch of new rows
+    """
+
+    def __init__(
+        self,
+        teams: List[str],
+        poll_interval_sec: float = DAEMON_POLL_INTERVAL_SEC,
+        scraper: Optional[CodTrackerScraper] = None,
+        google_sheets_api: Optional[GoogleSheetsApi] = None,
+    ):
+        self.teams = teams
+        self.poll_interval_sec = poll_interval_sec
+        self.scraper = scraper if scraper else CodTrackerScraper()
+        self.google_sheets_api = google_sheets_api if google_sheets_api else GoogleSheetsApi()
+        self.players: List[Player] = list(
+            {player.name: player for team in teams for player in TEAM_ROSTERS[team]}.values()
+        )
+        # (team, player name) -> newest match ID synced to that team's sheets. Loaded from the sheets' checkpoints
+        # on the first poll, then kept up to date from the polls
+        self.high_water_marks: Optional[Dict[Tuple[str, str], Optional[str]]] = None
+
+    @timed("daemon.load_high_water_marks")
+    def _load_high_water_marks(self) -> Dict[Tuple[str, str], Optional[str]]:
+        high_water_marks = {}
+        for team in self.teams:
+            player_names = [player.name for player in TEAM_ROSTERS[team]]
+            positions = self.google_sheets_api.get_sheet_positions(team, player_names)
+            for player_name in player_names:
+                high_water_marks[(team, player_name)] = positions[player_name].last_match_id
+        return high_water_marks
+
+    def _poll_newest_match_ids(self) -> Dict[str, Optional[str]]:
+        newest_match_ids = {}
+        for player in self.players:
+            try:
+                newest_match_ids[player.name] = self.scraper.get_newest_match_id_for_player(player)
+            except Exception as e:
+                # Treated as unchanged, the next poll tries again
+                print(f"Polling matches for {player.name} failed {str(e)}")
+        count("daemon_polls", amount=len(self.players))
+        return newest_match_ids
+
+    @timed("daemon.poll")
+    def poll_once(self) -> List[str]:
+        """
+        :return: The teams that had new matches and were synced
+        """
+        if self.high_water_marks is None:
+            try:
+                self.high_water_marks = self._load_high_water_marks()
+            except Exception as e:
+                print(f"Reading the sheets' checkpoints failed {str(e)}, retrying next poll")
+                return []
+
+        newest_match_ids = self._poll_newest_match_ids()
+        changed_teams = [
+            team
+            for team in self.teams
+            if any(
+                player.name in newest_match_ids
+                and newest_match_ids[player.name] != self.high_water_marks[(team, player.name)]
+                for player in TEAM_ROSTERS[team]
+            )
+        ]
+        if not changed_teams:
+            print("No new matches")
+            return []
+
+        print(f"New matches for {', '.join(changed_teams)}, syncing")
+        try:
+            with timer("daemon.sync"):
+                # A fresh aggregator per sync so its match cache doesn't grow for as long as the daemon runs
+                aggregator = TeamDataAggregator(scraper=self.scraper, google_sheets_api=self.google_sheets_api)
+                incomplete_players = aggregator.run_for_teams(changed_teams)
+        except Exception as e:
+            print(f"Syncing {', '.join(changed_teams)} failed {str(e)}, retrying next poll")
+            return []
+        # Marks move to what was polled rather than what was written, so matches that never get a row (e.g. other
+        # modes) don't trigger a sync on every poll. Players whose history failed to load keep their old mark, so
+        # their team is synced again next poll
+        for team in changed_teams:
+            for player in TEAM_ROSTERS[team]:
+                if player.name in newest_match_ids and player.name not in incomplete_players:
+                    self.high_water_marks[(team, player.name)] = newest_match_ids[player.name]
+        count("daemon_syncs", amount=len(changed_teams))
+        return changed_teams
+
+    def run(self, max_polls: Optional[int] = None) -> None:
+        """
+        Polls every poll_interval_sec until interrupted, or until max_polls polls have run
+        """
+        num_polls = 0
+        while True:
+            poll_start = monotonic()
+            self.poll_once()
+            num_polls += 1
+            if max_polls is not None and num_polls >= max_polls:
+                return
+            sleep(max(0.0, self.poll_interval_sec - (monotonic() - poll_start)))
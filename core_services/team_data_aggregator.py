@@ -1,115 +1,329 @@
-from typing import List, Dict
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Set, Optional, Tuple
 
 from constants import (
-    TIME_FORMAT,
-    TEAM_ROW_FORMAT,
-    INDIVIDUAL_PLAYER_ROW_FORMAT,
-    GAMERTAG_TO_NAME_MAP,
     TEAM_ROSTERS,
+    TEAM_INGEST_MAX_WORKERS,
 )
-from models.external_models.cod_tracker_models import WarzoneMatch, WarzonePlayerData
+from core_services.rolling_stats import RollingStatsEngine
+from core_services.row_builder import RowBuilder, SheetRow
+from models.external_models.cod_tracker_models import WarzoneMatch
 from models.player import Player
+from models.sheet_position import SheetPosition
 from external_services.cod_tracker_scraper import CodTrackerScraper
+from storage.analytics_store import AnalyticsStore
+from utils.instrumentation import timer, timed
 
-from external_services.google_sheets_api import GoogleSheetsApi
+from external_services.google_sheets_api import GoogleSheetsApi, OVERALL_SHEET, SUMMARY_SHEET
 
 
 class TeamDataAggregator:
-    def __init__(self):
-        self.scraper = CodTrackerScraper()
-        self.google_sheets_api = GoogleSheetsApi()
+    def __init__(
+        self,
+        max_workers: int = TEAM_INGEST_MAX_WORKERS,
+        scraper: Optional[CodTrackerScraper] = None,
+        google_sheets_api: Optional[GoogleSheetsApi] = None,
+    ):
+        self.scraper = scraper if scraper else CodTrackerScraper()
+        self.google_sheets_api = google_sheets_api if google_sheets_api else GoogleSheetsApi()
+        self.analytics_store = AnalyticsStore()
+        self.max_workers = max_workers
+        self.row_builder = RowBuilder()
+        self.rolling_stats_engine = RollingStatsEngine(row_builder=self.row_builder)
         self.warzone_match_cache: Dict[str, WarzoneMatch] = {}
+        # Matches that were fetched but can't be used for team stats (failed to load, or not a core mode)
+        self.unusable_match_ids: Set[str] = set()
+        # Rows waiting to be flushed to the current team's spreadsheet in one batch, keyed by sheet name
+        self.pending_sheet_rows: Dict[str, List[SheetRow]] = {}
 
-    def _get_team_roster_for_match(self, warzone_match_data: WarzoneMatch) -> List[str]:
-        players = [GAMERTAG_TO_NAME_MAP.get(p.gamertag, "Random") for p in warzone_match_data.players]
-        deduped_players = list(set(players))
-        deduped_players.sort()
-        return deduped_players
-
-    def _get_data_for_team_row(self, warzone_match_data: WarzoneMatch) -> List[str]:
-        utc_dt = datetime.utcfromtimestamp(warzone_match_data.metadata.start_time_ts)
-        formatted_time = utc_dt.strftime(TIME_FORMAT)
-        team_kills = sum(p.stats.kills for p in warzone_match_data.players)
-        team_deaths = sum(p.stats.deaths for p in warzone_match_data.players)
-        combined_dmg = sum(p.stats.damage_done for p in warzone_match_data.players)
-        game_length = max(p.stats.time_played_sec for p in warzone_match_data.players)
-        team_placement = next(p.stats.team_placement for p in warzone_match_data.players)
-        team_roster = self._get_team_roster_for_match(warzone_match_data)
-        team_row_as_str = TEAM_ROW_FORMAT.format(
-            match_id=warzone_match_data.metadata.match_id,
-            time=formatted_time,
-            game_duration=game_length,
-            placement=team_placement,
-            kills=team_kills,
-            deaths=team_deaths,
-            dmg_done=combined_dmg,
-            roster="|".join(team_roster),
-            mode=warzone_match_data.metadata.mode_name,
-            win=1 if team_placement == 1 else 0,
-            top_five=1 if team_placement <= 5 else 0,
-        )
-
-        return team_row_as_str.split(",")
-
-    def _get_data_for_individual_row(
-        self, warzone_player: WarzonePlayerData, warzone_match_data: WarzoneMatch
-    ) -> List[str]:
-        utc_dt = datetime.utcfromtimestamp(warzone_match_data.metadata.start_time_ts)
-        formatted_time = utc_dt.strftime(TIME_FORMAT)
-        team_roster = self._get_team_roster_for_match(warzone_match_data)
-        row_as_str = INDIVIDUAL_PLAYER_ROW_FORMAT.format(
-            match_id=warzone_match_data.metadata.match_id,
-            time=formatted_time,
-            placement=warzone_player.stats.team_placement,
-            kills=warzone_player.stats.kills,
-            deaths=warzone_player.stats.deaths,
-            gulag_kills=warzone_player.stats.gulag_kills,
-            dmg_done=warzone_player.stats.damage_done,
-            gulag_deaths=warzone_player.stats.gulag_deaths,
-            roster="|".join(team_roster),
-            mode=warzone_match_data.metadata.mode_name,
-        )
-        return row_as_str.split(",")
-
-    def write_team_stats_to_google_sheets(self, team: str):
+    def write_team_stats_to_google_sheets(self, team: str, match_ids: Optional[List[str]] = None):
         all_teammates = set(p.name for p in TEAM_ROSTERS[team])
-        all_matches_played_by_all_teammates = list(self.warzone_match_cache.values())
+        if match_ids is None:
+            all_matches_played_by_all_teammates = list(self.warzone_match_cache.values())
+        else:
+            all_matches_played_by_all_teammates = [
+                self.warzone_match_cache[match_id]
+                for match_id in set(match_ids)
+                if match_id in self.warzone_match_cache
+            ]
         all_matches_played_by_all_teammates.sort(key=lambda wz_match: wz_match.metadata.start_time_ts)
-        team_data = []
-        for match in all_matches_played_by_all_teammates:
-            team_roster = self._get_team_roster_for_match(match)
-            if len(set(team_roster) & all_teammates) < 2:
-                # If you haven't played with any of your other teammates, don't include it in the team charts
-                continue
-            row = self._get_data_for_team_row(match)
-            team_data.append(row)
-        self.google_sheets_api.write_new_game_data_for_team(team, team_data)
+        # If you haven't played with any of your other teammates, don't include it in the team charts
+        team_matches = [
+            match
+            for match in all_matches_played_by_all_teammates
+            if len(set(self.row_builder.get_team_roster(match)) & all_teammates) >= 2
+        ]
+        self.pending_sheet_rows[OVERALL_SHEET] = self.row_builder.build_team_rows(team_matches)
 
-    def write_warzone_individual_stats_to_google_sheets(self, player: Player, team: str, match_ids: List[str]):
-        indiv_rows_to_be_written = []
+    def _get_matches_played(self, player: Player, match_ids: List[str]) -> List[WarzoneMatch]:
+        """
+        :param player:
+        :param match_ids: Most recent first
+        :return: The matches the player played with the roster, oldest first
+        """
+        matches_played = []
         for match_id in match_ids[::-1]:
+            if match_id in self.unusable_match_ids:
+                continue
             if match_id not in self.warzone_match_cache:
                 match_data = self.scraper.get_team_data_for_match(match_id, player)
                 if not match_data:
+                    self.unusable_match_ids.add(match_id)
                     continue
                 self.warzone_match_cache[match_id] = match_data
             warzone_match_data = self.warzone_match_cache[match_id]
 
+            if not any(p.gamertag == player.display_name for p in warzone_match_data.players):
+                print(f"{player.name} was not on the same team as the other roster members in match {match_id}")
+                continue
+            matches_played.append(warzone_match_data)
+        return matches_played
+
+    def write_warzone_individual_stats_to_google_sheets(self, player: Player, team: str, match_ids: List[str]):
+        matches_played = self._get_matches_played(player, match_ids)
+        indiv_rows_to_be_written = self.row_builder.build_individual_rows(player.display_name, matches_played)
+        for row in indiv_rows_to_be_written:
+            print(row)
+        self.pending_sheet_rows[player.name] = indiv_rows_to_be_written
+        self.record_matches_in_analytics_store(player, matches_played)
+        self.rolling_stats_engine.stage_player_matches(team, player.name, player.display_name, matches_played)
+
+    @timed("team.record_analytics")
+    def record_matches_in_analytics_store(self, player: Player, matches_played: List[WarzoneMatch]) -> None:
+        records = []
+        for warzone_match_data in matches_played:
             warzone_player = next(p for p in warzone_match_data.players if p.gamertag == player.display_name)
-            row = self._get_data_for_individual_row(
-                warzone_player=warzone_player, warzone_match_data=warzone_match_data
+            records.append(
+                (
+                    warzone_match_data.metadata.match_id,
+                    warzone_match_data.metadata.start_time_ts,
+                    warzone_match_data.metadata.mode_name,
+                    "|".join(self.row_builder.get_team_roster(warzone_match_data)),
+                    warzone_player.stats,
+                )
             )
-            print(row)
-            indiv_rows_to_be_written.append(row)
-
-        self.google_sheets_api.write_new_game_data_for_player(player, team, indiv_rows_to_be_written)
-
-    def run_for_team(self, team: str) -> None:
-        total_roster = TEAM_ROSTERS[team]
-        for player in total_roster:
-            print(f"\nPulling stats for {player.name}")
-            latest_match_recorded = self.google_sheets_api.get_last_match_recorded(player, team)
-            match_ids = self.scraper.get_all_new_match_ids_for_player(player, latest_match_recorded)
-            self.write_warzone_individual_stats_to_google_sheets(player, team, match_ids)
-        self.write_team_stats_to_google_sheets(team)
+        self.analytics_store.record_player_matches(player.name, records)
+
+    @timed("team.fetch_matches")
+    def fetch_new_matches_for_players(
+        self, players: List[Player], last_positions_by_player: Dict[str, Optional[SheetPosition]]
+    ) -> Dict[str, Optional[List[str]]]:
+        """
+        Streams every player's new match IDs concurrently and starts downloading each match as soon as its ID
+        arrives. Squadmates share most of their matches, so each distinct match is only fetched once
+        :param players:
+        :param last_positions_by_player: The high-water mark to paginate back to for each player
+        :return: Mapping of player name to their new match IDs, most recent first. None for players whose
+        pagination failed part way, since writing only their newest matches would move the sheet's high-water mark
+        past the ones that were missed
+        """
+        fetch_futures: Dict[str, Future] = {}
+        fetch_futures_lock = threading.Lock()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as fetch_executor:
+
+            def paginate(player: Player) -> Optional[List[str]]:
+                print(f"Pulling match IDs for {player.name}")
+                last_position = last_positions_by_player[player.name]
+                match_ids = []
+                try:
+                    for match_id in self.scraper.iter_new_match_ids_for_player(
+                        player,
+                        last_position.last_match_id if last_position else None,
+                        last_position.last_start_ts if last_position else None,
+                    ):
+                        match_ids.append(match_id)
+                        with fetch_futures_lock:
+                            if match_id in fetch_futures or match_id in self.warzone_match_cache:
+                                continue
+                            if match_id in self.unusable_match_ids:
+                                continue
+                            fetch_futures[match_id] = fetch_executor.submit(
+                                self.scraper.get_team_data_for_match, match_id, player
+                            )
+                except Exception as e:
+                    print(f"Pulling match IDs for {player.name} failed after {len(match_ids)} matches {str(e)}")
+                    return None
+                return match_ids
+
+            with ThreadPoolExecutor(max_workers=max(1, min(len(players), self.max_workers))) as page_executor:
+                all_match_ids = list(page_executor.map(paginate, players))
+
+        total_requested = sum(len(match_ids) for match_ids in all_match_ids if match_ids)
+        print(f"Fetched {len(fetch_futures)} distinct matches ({total_requested} requested across the roster)")
+        for match_id, future in fetch_futures.items():
+            match_data = future.result()
+            if match_data:
+                self.warzone_match_cache[match_id] = match_data
+            else:
+                self.unusable_match_ids.add(match_id)
+        return {player.name: match_ids for player, match_ids in zip(players, all_match_ids)}
+
+    @staticmethod
+    def _get_oldest_position(positions: List[SheetPosition]) -> Optional[SheetPosition]:
+        """
+        A player on several teams has one high-water mark per team spreadsheet. Pagination has to reach the oldest
+        of them so every sheet gets its new matches
+        """
+        if not positions or len(positions) == 1:
+            return positions[0] if positions else None
+        if any(not position.last_match_id or position.last_start_ts is None for position in positions):
+            # Either nothing is recorded yet or the marks can't be ordered, so pull the full window
+            return None
+        return min(positions, key=lambda position: position.last_start_ts)
+
+    def _get_match_ids_since(self, match_ids: List[str], last_position: Optional[SheetPosition]) -> List[str]:
+        """
+        Cuts a player's shared match IDs down to the ones newer than one sheet's high-water mark. Pagination went
+        back to the oldest mark across the player's teams, so this sheet's last match may not be in the list at all
+        (e.g. the sheet was edited by hand), and then the start time is what stops older matches being written twice
+        """
+        if not last_position:
+            return match_ids
+        if last_position.last_match_id in match_ids:
+            match_ids = match_ids[: match_ids.index(last_position.last_match_id)]
+        if last_position.last_start_ts is None:
+            return match_ids
+        return [
+            match_id
+            for match_id in match_ids
+            if match_id not in self.warzone_match_cache
+            or self.warzone_match_cache[match_id].metadata.start_time_ts >= last_position.last_start_ts
+        ]
+
+    def run_for_teams(self, teams: List[str]) -> Set[str]:
+        """
+        Updates several teams in one pass. Each distinct player's match IDs are paginated once and each distinct
+        match is fetched once, then rows are fanned out to every team spreadsheet the player appears in
+        :return: Names of the players whose history failed to load, whose sheets were left for the next run
+        """
+        with timer("team.sheet_positions"):
+            sheet_positions_by_team = {
+                team: self.google_sheets_api.get_sheet_positions(
+                    team, [player.name for player in TEAM_ROSTERS[team]] + [OVERALL_SHEET]
+                )
+                for team in teams
+            }
+        distinct_players: Dict[str, Player] = {}
+        for team in teams:
+            for player in TEAM_ROSTERS[team]:
+                distinct_players.setdefault(player.name, player)
+        last_positions_by_player = {
+            name: self._get_oldest_position(
+                [sheet_positions_by_team[team][name] for team in teams if name in sheet_positions_by_team[team]]
+            )
+            for name in distinct_players
+        }
+
+        match_ids_by_player = self.fetch_new_matches_for_players(
+            list(distinct_players.values()), last_positions_by_player
+        )
+
+        pending_sheet_rows_by_team = {}
+        for team in teams:
+            print(f"\nBuilding rows for {team}")
+            sheet_positions = sheet_positions_by_team[team]
+            self.pending_sheet_rows = {}
+            team_match_ids = []
+            incomplete_players = [
+                player.name for player in TEAM_ROSTERS[team] if match_ids_by_player[player.name] is None
+            ]
+            with timer("team.build_rows", team):
+                for player in TEAM_ROSTERS[team]:
+                    if player.name in incomplete_players:
+                        # Left untouched, sheet and checkpoint included, so the next run picks up every missed match
+                        print(f"Skipping {player.name}'s sheet for {team} this run since their history didn't load")
+                        continue
+                    match_ids = self._get_match_ids_since(
+                        match_ids_by_player[player.name], sheet_positions.get(player.name)
+                    )
+                    self.write_warzone_individual_stats_to_google_sheets(player, team, match_ids)
+                    # A player's sheet can lag the Overall sheet (e.g. a new roster member), so team matches are cut
+                    # at the Overall sheet's own mark too. Each list is cut on its own since only it is in order
+                    team_match_ids.extend(self._get_match_ids_since(match_ids, sheet_positions.get(OVERALL_SHEET)))
+                if incomplete_players:
+                    # Team matches only some of the missing history covered could be skipped over for good
+                    print(f"Skipping the {OVERALL_SHEET} sheet for {team} this run")
+                else:
+                    self.write_team_stats_to_google_sheets(team, team_match_ids)
+            pending_sheet_rows_by_team[team] = self.pending_sheet_rows
+        self.pending_sheet_rows = {}
+
+        with timer("team.rolling_stats"):
+            self.rolling_stats_engine.apply_staged_matches()
+        for team in teams:
+            summary_rows = self.rolling_stats_engine.get_summary_rows(
+                team, [player.name for player in TEAM_ROSTERS[team]]
+            )
+            with timer("team.write_sheets", team):
+                self.google_sheets_api.write_new_game_data_for_sheets(
+                    team,
+                    pending_sheet_rows_by_team[team],
+                    sheet_positions_by_team[team],
+                    replacement_sheet_data={SUMMARY_SHEET: summary_rows},
+                )
+        return {name for name, match_ids in match_ids_by_player.items() if match_ids is None}
+
+    @staticmethod
+    def _is_before(start_ts: Optional[int], first_recorded_start_ts: Optional[int]) -> bool:
+        if first_recorded_start_ts is None:
+            return True
+        return start_ts is not None and start_ts < first_recorded_start_ts
+
+    @timed("team.backfill_sheets")
+    def write_backfilled_matches_for_team(
+        self, team: str, backfilled_matches_by_player: Dict[str, List[Tuple[str, Optional[int]]]]
+    ) -> int:
+        """
+        Adds the backfilled matches that are older than each sheet's first recorded row, oldest first, so the sheets
+        gain the history from before they were started. Matches are read from the local match store, so this makes no
+        tracker.gg requests once the backfill has finished. Rolling stats only move forwards, so the Summary tab is
+        left alone
+        :param team:
+        :param backfilled_matches_by_player: Mapping of player name to (match_id, start timestamp) pairs, most
+        recent first
+        :return: How many rows were written
+        """
+        sheet_positions = self.google_sheets_api.get_sheet_positions(
+            team, [player.name for player in TEAM_ROSTERS[team]] + [OVERALL_SHEET]
+        )
+        first_start_ts = self.google_sheets_api.get_first_recorded_start_ts(team, sheet_positions)
+        self.pending_sheet_rows = {}
+        team_match_ids = []
+        for player in TEAM_ROSTERS[team]:
+            candidate_match_ids = [
+                match_id
+                for match_id, start_ts in backfilled_matches_by_player.get(player.name, [])
+                if self._is_before(start_ts, first_start_ts[player.name])
+                or self._is_before(start_ts, first_start_ts[OVERALL_SHEET])
+            ]
+            matches_played = self._get_matches_played(player, candidate_match_ids)
+            older_matches = [
+                match
+                for match in matches_played
+                if self._is_before(match.metadata.start_time_ts, first_start_ts[player.name])
+            ]
+            self.pending_sheet_rows[player.name] = self.row_builder.build_individual_rows(
+                player.display_name, older_matches
+            )
+            self.record_matches_in_analytics_store(player, older_matches)
+            team_match_ids.extend(
+                match.metadata.match_id
+                for match in matches_played
+                if self._is_before(match.metadata.start_time_ts, first_start_ts[OVERALL_SHEET])
+            )
+        self.write_team_stats_to_google_sheets(team, team_match_ids)
+
+        pending_sheet_rows = self.pending_sheet_rows
+        self.pending_sheet_rows = {}
+        self.google_sheets_api.write_older_game_data_for_sheets(team, pending_sheet_rows, sheet_positions)
+        num_rows = sum(len(rows) for rows in pending_sheet_rows.values())
+        print(f"Wrote {num_rows} backfilled rows for {team}")
+        return num_rows
+
+    def run_for_team(self, team: str) -> Set[str]:
+        return self.run_for_teams([team])
+
+    def run_for_all_teams(self) -> Set[str]:
+        return self.run_for_teams(list(TEAM_ROSTERS))
@@ -1,82 +1,200 @@
+import copy
 import urllib.parse
-from typing import Tuple, List, Optional, Dict, Any
+from concurrent.futures import Executor
+from typing import Tuple, List, Optional, Dict, Any, Iterator
 
 import requests
-from bs4 import BeautifulSoup
-from marshmallow import ValidationError
 
-from constants import MAX_CALLS, CORE_MODES
+from constants import (
+    MAX_CALLS,
+    CORE_MODES,
+    ACTIVISION_ID_TTL_SEC,
+    L7D_KD_TTL_SEC,
+    NEGATIVE_LOOKUP_TTL_SEC,
+    STRICT_MATCH_VALIDATION,
+)
+from models.external_models.cod_tracker_models import WarzoneMatch
+from models.external_models.compact_cod_tracker_models import CompactWarzoneMatch
 from models.player import Player
-from schemas.warzone_match_schema import WarzoneMatch, WARZONE_MATCH_SCHEMA
+from schemas.warzone_match_decoder import (
+    decode_warzone_match,
+    decode_allied_warzone_match,
+    decode_compact_warzone_match,
+    get_mode_name,
+    load_json,
+    MatchDecodeError,
+)
+from external_services.http_transport import HttpTransport
+from storage.lookup_cache import LookupCache
+from storage.match_store import MatchStore
+from utils.instrumentation import count, timer, timed
+from utils.single_flight import SingleFlight
 
 PLAYER_MATCH_DATA_URL = "https://api.tracker.gg/api/v1/warzone/matches/atvi/{}?type=wz&next={}"
 MATCH_DATA_URL = "https://api.tracker.gg/api/v1/warzone/matches/{}"
 PLAYER_OVERVIEW_URL = "https://cod.tracker.gg/warzone/profile/{}/{}?overview"
 PLAYER_SEARCH_URL = "https://api.tracker.gg/api/v2/warzone/standard/search?platform={}&query={}&autocomplete=true"
 
+ACTIVISION_ID_CACHE = "activision_id"
+L7D_KD_CACHE = "l7d_kd"
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
 }
 
 
 class CodTrackerScraper:
-    def get_all_new_match_ids_for_player(self, player: Player, last_match_recorded: Optional[str]) -> List[str]:
+    def __init__(
+        self,
+        transport: Optional[HttpTransport] = None,
+        match_store: Optional[MatchStore] = None,
+        lookup_cache: Optional[LookupCache] = None,
+        strict_validation: bool = STRICT_MATCH_VALIDATION,
+    ):
+        self.strict_validation = strict_validation
+        self.transport = transport if transport else HttpTransport()
+        self.match_store = match_store if match_store else MatchStore()
+        self.lookup_cache = lookup_cache if lookup_cache else LookupCache()
+        # First-page URL -> newest match ID seen by get_newest_match_id_for_player
+        self._newest_match_ids: Dict[str, Optional[str]] = {}
+        # Squadmates' pagination streams and enemy scans ask for the same matches and players at the same moment.
+        # Concurrent lookups of one resource share a single request, and since each one ends by writing to the match
+        # store or lookup cache, later lookups are served locally. That keeps it to one request per resource per run
+        self._match_flights = SingleFlight("match")
+        self._search_flights = SingleFlight("search")
+        self._profile_flights = SingleFlight("profile")
+
+    def get_all_new_match_ids_for_player(
+        self, player: Player, last_match_recorded: Optional[str], last_recorded_start_ts: Optional[int] = None
+    ) -> List[str]:
         """
         Fetches all matches a player has played up to a given end match or the 100 most recent (whichever is smaller)
         :param player:
         :param last_match_recorded:
+        :param last_recorded_start_ts:
+        :return:
+        """
+        return list(self.iter_new_match_ids_for_player(player, last_match_recorded, last_recorded_start_ts))
+
+    def iter_new_match_ids_for_player(
+        self,
+        player: Player,
+        last_match_recorded: Optional[str],
+        last_recorded_start_ts: Optional[int] = None,
+        max_calls: int = MAX_CALLS,
+    ) -> Iterator[str]:
+        """
+        Yields a player's match IDs, most recent first, as each page arrives. Stops at last_match_recorded, at the
+        first match that started before last_recorded_start_ts (in case the recorded match isn't in the history, e.g.
+        the sheet was edited by hand), or after max_calls pages. Raises if a page still fails after retries, so
+        callers never mistake a partial history for a complete one
+        :param player:
+        :param last_match_recorded:
+        :param last_recorded_start_ts:
+        :param max_calls:
         :return:
         """
         pagination_token = None
-        all_new_match_ids = []
         num_calls_so_far = 0
-        while num_calls_so_far < MAX_CALLS:
-            match_ids, pagination_token = self._get_match_ids_for_player(player, pagination_token)
-            for match_id in match_ids:
-                if match_id == last_match_recorded:
-                    return all_new_match_ids
-                all_new_match_ids.append(match_id)
+        while num_calls_so_far < max_calls:
+            matches, pagination_token = self.fetch_match_page_for_player(player, pagination_token)
             num_calls_so_far += 1
+            for match_id, start_ts in matches:
+                if match_id == last_match_recorded:
+                    return
+                if last_recorded_start_ts is not None and start_ts is not None and start_ts < last_recorded_start_ts:
+                    print(f"Reached matches older than the last one recorded for {player.display_name}")
+                    return
+                yield match_id
+            if pagination_token is None:
+                # This was the last page. Asking for the "null" token again would restart from the most recent match
+                return
 
-        return all_new_match_ids
-
-    def _get_match_ids_for_player(self, player: Player, page_start: Optional[str]) -> Tuple[List[str], Optional[str]]:
+    @timed("scraper.match_page")
+    def fetch_match_page_for_player(
+        self, player: Player, page_start: Optional[str]
+    ) -> Tuple[List[Tuple[str, Optional[int]]], Optional[str]]:
         """
-        Returns the next recent 20 match_ids for a player given a pagination start token
+        Returns the next recent 20 (match_id, start timestamp) pairs for a player given a pagination start token
         If no token is provided, it will begin at the most recent match
         :param player:
         :param page_start:
-        :return:
+        :return: The page's matches and the token for the next page, which is None after the last page
         """
         pagination_token = page_start if page_start else "null"
         url = PLAYER_MATCH_DATA_URL.format(player.get_urlencoded_activision_username(), pagination_token)
-        match_ids = []
-        try:
-            resp = requests.get(url, headers=HEADERS)
-            resp.raise_for_status()
-        except Exception as e:
-            print(f"Fetching data for {player.display_name} failed {str(e)}")
-            return [], None
+        resp = self.transport.get("match_ids", url, headers=HEADERS)
+        return self._parse_match_page(resp)
 
+    @staticmethod
+    def _parse_match_page(resp: requests.Response) -> Tuple[List[Tuple[str, Optional[int]]], Optional[str]]:
+        matches = []
         resp_data = resp.json()["data"]
         matches_data = resp_data["matches"]
         for match_data in matches_data:
             match_id = match_data["attributes"]["id"]
-            match_ids.append(match_id)
-        return match_ids, resp_data["metadata"]["next"]
+            try:
+                start_ts = int(match_data["metadata"]["timestamp"])
+            except (KeyError, TypeError, ValueError):
+                start_ts = None
+            matches.append((match_id, start_ts))
+        return matches, resp_data["metadata"]["next"]
+
+    @timed("scraper.poll_newest_match")
+    def get_newest_match_id_for_player(self, player: Player) -> Optional[str]:
+        """
+        Cheap check for new matches, for polling. The first page of the player's history is requested conditionally,
+        so if tracker.gg answers 304 Not Modified the newest match ID from the previous poll is reused
+        :param player:
+        :return: The player's most recent match ID, or None if they have no matches
+        """
+        url = PLAYER_MATCH_DATA_URL.format(player.get_urlencoded_activision_username(), "null")
+        resp = self.transport.get_if_changed("match_ids", url, headers=HEADERS)
+        if resp is None:
+            if url in self._newest_match_ids:
+                return self._newest_match_ids[url]
+            # Another scraper sharing the transport made the earlier request, so there's nothing to reuse
+            resp = self.transport.get("match_ids", url, headers=HEADERS)
+        matches, _ = self._parse_match_page(resp)
+        self._newest_match_ids[url] = matches[0][0] if matches else None
+        return self._newest_match_ids[url]
 
+    @timed("scraper.player_search")
     def _make_request_for_player_search(self, platform: str, gamertag: str) -> List[Dict[str, Any]]:
         url_encoded_tag = urllib.parse.quote(gamertag)
         url = PLAYER_SEARCH_URL.format(platform, url_encoded_tag)
         try:
-            resp = requests.get(url, headers=HEADERS)
-            resp.raise_for_status()
-            return resp.json()["data"]
+            resp = self.transport.get("search", url, headers=HEADERS)
+        except requests.HTTPError as e:
+            if self._is_not_found(e):
+                return []
+            raise
+        return resp.json()["data"]
+
+    @staticmethod
+    def _is_not_found(e: requests.HTTPError) -> bool:
+        return e.response is not None and e.response.status_code == 404
+
+    def get_activision_id_for_gamertag(self, gamertag: str) -> Tuple[Optional[str], str]:
+        return self._search_flights.do(gamertag, self._look_up_activision_id_for_gamertag, gamertag)
+
+    def _look_up_activision_id_for_gamertag(self, gamertag: str) -> Tuple[Optional[str], str]:
+        hit, cached_value = self.lookup_cache.get(ACTIVISION_ID_CACHE, gamertag)
+        if hit:
+            activision_id, platform = cached_value
+            return activision_id, platform
+
+        try:
+            activision_id, platform = self._search_for_activision_id(gamertag)
         except Exception as e:
+            # Only an answer from tracker.gg is cached, so a transient failure doesn't hide the player for a while
             print(f"Getting Activision ID for {gamertag} failed {str(e)}")
-            return []
+            return None, "atvi"
+        ttl_sec = ACTIVISION_ID_TTL_SEC if activision_id is not None else NEGATIVE_LOOKUP_TTL_SEC
+        self.lookup_cache.set(ACTIVISION_ID_CACHE, gamertag, [activision_id, platform], ttl_sec)
+        return activision_id, platform
 
-    def get_activision_id_for_gamertag(self, gamertag: str) -> Tuple[Optional[str], str]:
+    def _search_for_activision_id(self, gamertag: str) -> Tuple[Optional[str], str]:
         print(f"Getting Activision ID for {gamertag}")
         platform = "atvi"
         search_data = self._make_request_for_player_search(platform, gamertag)
@@ -111,28 +229,68 @@ class CodTrackerScraper:
         print(f"Could not find Activision ID for {gamertag}")
         return None, platform
 
-    def get_last_7d_kd_ratio_for_player(self, player: Player) -> Optional[float]:
-        print(f"Getting last 7d KD for {player.display_name} from {player.platform}")
+    def get_last_7d_kd_ratio_for_player(
+        self, player: Player, parse_executor: Optional[Executor] = None
+    ) -> Optional[float]:
         url = PLAYER_OVERVIEW_URL.format(player.platform, player.get_urlencoded_activision_username())
-        page = requests.get(url)
-        soup = BeautifulSoup(page.content, "html.parser")
-        l7d_tag = soup.body.find(text="Last 7 Days")
-        if not l7d_tag:
+        return self._profile_flights.do(url, self._look_up_last_7d_kd_ratio_for_player, player, parse_executor)
+
+    def _look_up_last_7d_kd_ratio_for_player(
+        self, player: Player, parse_executor: Optional[Executor] = None
+    ) -> Optional[float]:
+        cache_key = f"{player.platform}/{player.get_urlencoded_activision_username()}"
+        hit, kd = self.lookup_cache.get(L7D_KD_CACHE, cache_key)
+        if hit:
+            return kd
+
+        try:
+            kd = self._scrape_last_7d_kd_ratio_for_player(player, parse_executor)
+        except Exception as e:
+            # Only an answer from tracker.gg is cached, so a transient failure doesn't hide the player for a while
+            print(f"Fetching profile for {player.display_name} failed {str(e)}")
             return None
-        last_7d_games_played = l7d_tag.parent.parent
-        all_numbers = last_7d_games_played.find_all("div", class_="numbers")
+        ttl_sec = L7D_KD_TTL_SEC if kd is not None else NEGATIVE_LOOKUP_TTL_SEC
+        self.lookup_cache.set(L7D_KD_CACHE, cache_key, kd, ttl_sec)
+        return kd
+
+    @timed("scraper.profile_page")
+    def _scrape_last_7d_kd_ratio_for_player(
+        self, player: Player, parse_executor: Optional[Executor] = None
+    ) -> Optional[float]:
+        # bs4 is only needed once a profile page is actually scraped
+        from external_services.profile_page_parser import (
+            get_last_7d_fragments,
+            parse_last_7d_kd_ratio_from_fragments,
+            parse_last_7d_kd_ratio_full_page,
+        )
+
+        print(f"Getting last 7d KD for {player.display_name} from {player.platform}")
+        url = PLAYER_OVERVIEW_URL.format(player.platform, player.get_urlencoded_activision_username())
         try:
-            kd = float(
-                next(
-                    n.find("span", class_="value").text
-                    for n in all_numbers
-                    if n.find("span", class_="name").text == "K/D Ratio"
-                )
-            )
+            page = self.transport.get("profile", url)
+        except requests.HTTPError as e:
+            if self._is_not_found(e):
+                print(f"No profile found for {player.display_name}")
+                return None
+            raise
+
+        def parse(parse_func, arg):
+            if parse_executor:
+                # Parse on another process so HTML parsing doesn't hold up the threads waiting on the network
+                return parse_executor.submit(parse_func, arg).result()
+            return parse_func(arg)
+
+        # Includes waiting for a free worker when parsing on another process
+        with timer("parse.profile_page"):
+            # Only the fragments are sent to the worker, since copying the whole page there costs more than parsing
+            # them. The whole page is only parsed if none of them had the stat
+            fragments = get_last_7d_fragments(page.text)
+            kd = parse(parse_last_7d_kd_ratio_from_fragments, fragments) if fragments else None
+            if fragments and kd is None:
+                kd = parse(parse_last_7d_kd_ratio_full_page, page.text)
+        if kd is not None:
             print(f"L7D K/D for {player.display_name} is {kd}")
-            return kd
-        except StopIteration:
-            return None
+        return kd
 
     def _filter_out_non_allied_players(self, player: Player, warzone_match_data: WarzoneMatch) -> WarzoneMatch:
         wz_player_data = next(p for p in warzone_match_data.players if p.gamertag == player.display_name)
@@ -141,20 +299,73 @@ class CodTrackerScraper:
         warzone_match_data.players = allied_players
         return warzone_match_data
 
-    def _get_match_data(self, match_id: str, player: Optional[Player] = None) -> Optional[WarzoneMatch]:
-        url = MATCH_DATA_URL.format(match_id)
-        params = {"handle": player.get_urlencoded_display_name()} if player else {}
+    def _get_raw_match_data(self, match_id: str, player: Optional[Player] = None) -> Optional[Dict[str, Any]]:
+        return self._match_flights.do(match_id, self._load_raw_match_data, match_id, player)
+
+    def _load_raw_match_data(self, match_id: str, player: Optional[Player] = None) -> Optional[Dict[str, Any]]:
+        raw_match_data = self.match_store.get_raw_match_data(match_id)
+        if raw_match_data:
+            print(f"Loaded match {match_id} from the local match store")
+            count("match_store_hits", "raw")
+            return raw_match_data
+        count("match_store_misses", "raw")
+
         try:
-            resp = requests.get(url, headers=HEADERS, params=params)
-            resp.raise_for_status()
+            raw_match_data = self.fetch_raw_match_data(match_id, player)
         except Exception as e:
             print(f"Fetching data for match {match_id} failed with {str(e)}")
             return None
 
+        with timer("store.put_match"):
+            self.match_store.put_match(match_id, raw_match_data, None)
+        return raw_match_data
+
+    def fetch_raw_match_data(self, match_id: str, player: Optional[Player] = None) -> Dict[str, Any]:
+        """
+        Downloads a match without checking or writing the local match store, for callers that store in bulk
+        """
+        url = MATCH_DATA_URL.format(match_id)
+        params = {"handle": player.get_urlencoded_display_name()} if player else {}
+        resp = self.transport.get("match", url, headers=HEADERS, params=params)
+        with timer("parse.match_json"):
+            return load_json(resp.content)["data"]
+
+    def _get_match_data(self, match_id: str, player: Optional[Player] = None) -> Optional[WarzoneMatch]:
+        stored_match = self.match_store.get_match(match_id)
+        if stored_match:
+            print(f"Loaded match {match_id} from the local match store")
+            count("match_store_hits", "parsed")
+            return stored_match
+
+        raw_match_data = self._get_raw_match_data(match_id, player)
+        if not raw_match_data:
+            return None
+        warzone_match = self._parse_match_data(match_id, raw_match_data)
+        if not warzone_match:
+            return None
+
+        self.match_store.put_parsed_match(match_id, warzone_match)
+        return warzone_match
+
+    def _parse_match_data(self, match_id: str, raw_match_data: Dict[str, Any]) -> Optional[WarzoneMatch]:
+        if self.strict_validation:
+            # marshmallow is slow to import and only used for strict validation
+            from marshmallow import ValidationError
+            from schemas.warzone_match_schema import WARZONE_MATCH_SCHEMA
+
+            try:
+                # The schema's pre_load rewrites the payload in place, so load from a copy and keep the raw JSON intact
+                with timer("parse.match", "marshmallow"):
+                    return WARZONE_MATCH_SCHEMA.load(copy.deepcopy(raw_match_data))
+            except ValidationError as ve:
+                print(f"Fetching data for {match_id} failed with a Marshmallow error {str(ve)}")
+                return None
+
         try:
-            return WARZONE_MATCH_SCHEMA.load(resp.json()["data"])
-        except ValidationError as ve:
-            print(f"Fetching data for {match_id} failed with a Marshmallow error {str(ve)}")
+            with timer("parse.match", "decoder"):
+                return decode_warzone_match(raw_match_data)
+        except MatchDecodeError as e:
+            print(f"Fetching data for {match_id} failed with a decode error {str(e)}")
             return None
 
     def get_all_data_for_match(self, match_id: str) -> WarzoneMatch:
@@ -164,11 +375,46 @@ class CodTrackerScraper:
             return None
         return match_data
 
+    def get_all_compact_data_for_match(self, match_id: str) -> Optional[CompactWarzoneMatch]:
+        print(f"Fetching enemy data for match {match_id}")
+        compact_match = self.match_store.get_compact_match(match_id)
+        if compact_match:
+            count("match_store_hits", "compact")
+            return compact_match
+        raw_match_data = self._get_raw_match_data(match_id)
+        if not raw_match_data:
+            return None
+        try:
+            with timer("parse.match", "compact"):
+                compact_match = decode_compact_warzone_match(raw_match_data)
+        except MatchDecodeError as e:
+            print(f"Fetching data for {match_id} failed with a decode error {str(e)}")
+            return None
+        self.match_store.put_parsed_match(match_id, compact_match)
+        return compact_match
+
     def get_team_data_for_match(self, match_id: str, player: Player) -> Optional[WarzoneMatch]:
         print(f"Fetching data for match {match_id}")
-        warzone_match_data = self._get_match_data(match_id, player)
-        if not warzone_match_data:
+        if self.strict_validation:
+            warzone_match_data = self._get_match_data(match_id, player)
+            if not warzone_match_data:
+                return None
+            if warzone_match_data.metadata.mode_name not in CORE_MODES:
+                return None
+            return self._filter_out_non_allied_players(player, warzone_match_data)
+
+        raw_match_data = self._get_raw_match_data(match_id, player)
+        if not raw_match_data:
             return None
-        if warzone_match_data.metadata.mode_name not in CORE_MODES:
+        # Only the mode is read before deciding whether to decode, and only the player's own team is decoded
+        if get_mode_name(raw_match_data) not in CORE_MODES:
             return None
-        return self._filter_out_non_allied_players(player, warzone_match_data)
+        try:
+            with timer("parse.match", "allied"):
+                warzone_match_data = decode_allied_warzone_match(raw_match_data, player.display_name)
+        except MatchDecodeError as e:
+            print(f"Fetching data for {match_id} failed with a decode error {str(e)}")
+            return None
+        if not warzone_match_data:
+            print(f"{player.display_name} was not found in match {match_id}")
+        return warzone_match_data
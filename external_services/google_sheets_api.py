@@ -1,66 +1,452 @@
 import pickle
 import os.path
-from typing import Optional, List
+from dataclasses import replace
+from datetime import datetime, timezone
+from time import time
+from typing import Optional, List, Dict
 
-from googleapiclient import discovery
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from constants import (
+    TEAM_TO_SHEET_ID,
+    TIME_FORMAT,
+    SHEETS_API_BASE_URL,
+    SHEETS_TOKEN_PATH,
+    SHEETS_LEGACY_TOKEN_PATH,
+    SHEETS_CLIENT_SECRETS_PATH,
+)
+from external_services.http_fixtures import is_replaying
+from external_services.sheets_rest_client import SheetsRestClient, SheetsApiError
+from models.sheet_position import SheetPosition
+from utils.instrumentation import timed
 
-from constants import TEAM_TO_SHEET_ID
-from models.player import Player
-
-# If modifying these scopes, delete the file token.pickle.
+# If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-RANGE = "A:Z"
+OVERALL_SHEET = "Overall"
+# Small metadata tab holding each sheet's high-water mark, so runs never have to download whole player tabs
+CHECKPOINT_SHEET = "Checkpoints"
+CHECKPOINT_HEADER = ["sheet", "last_match_id", "last_start_ts", "next_row", "updated_at", "row_count"]
+TAIL_WINDOW_ROWS = 200
+# Tab that is fully rewritten each run with precomputed rolling stats
+SUMMARY_SHEET = "Summary"
+# Tabs this class creates on demand, since they aren't part of the original spreadsheet layout
+MANAGED_SHEETS = (CHECKPOINT_SHEET, SUMMARY_SHEET)
 
 
 class GoogleSheetsApi:
-    def __init__(self):
-        self.credentials = self.get_or_create_authorization()
-        self.google_sheets_service = discovery.build("sheets", "v4", credentials=self.credentials)
+    def __init__(self, base_url: str = SHEETS_API_BASE_URL, session=None):
+        # A non-default base URL is a local fake server and replayed fixtures need no server, so neither needs
+        # Google credentials
+        needs_credentials = base_url == SHEETS_API_BASE_URL and session is None and not is_replaying()
+        self.credentials = self.get_or_create_authorization() if needs_credentials else None
+        self.sheets_client = SheetsRestClient(self.credentials, base_url=base_url, session=session)
+        # Number of checkpoint rows last read per spreadsheet, so stale rows can be blanked when rewriting the tab
+        self._checkpoint_row_counts: Dict[str, int] = {}
+        # Grid row count of each tab per spreadsheet, as recorded in the Checkpoints tab or last fetched, so writes only
+        # fetch the spreadsheet when a tab may be too small
+        self._grid_row_counts: Dict[str, Dict[str, int]] = {}
 
+    @timed("sheets.authorize")
     def get_or_create_authorization(self):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
         creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first time
-        if os.path.exists("token.pickle"):
-            with open("token.pickle", "rb") as token:
+        # The token file stores the user's access and refresh tokens, and is created automatically when the
+        # authorization flow completes for the first time
+        if os.path.exists(SHEETS_TOKEN_PATH):
+            creds = Credentials.from_authorized_user_file(SHEETS_TOKEN_PATH, SCOPES)
+        elif os.path.exists(SHEETS_LEGACY_TOKEN_PATH):
+            # Older installs pickled the credentials. They're rewritten as JSON below
+            with open(SHEETS_LEGACY_TOKEN_PATH, "rb") as token:
                 creds = pickle.load(token)
+        if creds and creds.valid and not os.path.exists(SHEETS_TOKEN_PATH):
+            self._save_authorization(creds)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
             else:
-                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+                from google_auth_oauthlib.flow import InstalledAppFlow
+
+                flow = InstalledAppFlow.from_client_secrets_file(SHEETS_CLIENT_SECRETS_PATH, SCOPES)
                 creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open("token.pickle", "wb") as token:
-                pickle.dump(creds, token)
+            # Save the credentials so the next run can reuse the access token instead of refreshing it again
+            self._save_authorization(creds)
         return creds
 
-    def _append_data_to_sheet(self, spreadsheet_id: str, sheet: str, data: List[List[str]]) -> None:
-        body = {"values": data}
-        request = (
-            self.google_sheets_service.spreadsheets()
-            .values()
-            .append(spreadsheetId=spreadsheet_id, range=sheet, body=body, valueInputOption="USER_ENTERED")
+    @staticmethod
+    def _save_authorization(creds) -> None:
+        with open(SHEETS_TOKEN_PATH, "w") as token:
+            token.write(creds.to_json())
+
+    def _batch_get_values(self, spreadsheet_id: str, ranges: List[str]) -> List[List[List[str]]]:
+        result = self.sheets_client.batch_get_values(spreadsheet_id, ranges)
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+
+    @timed("sheets.ensure_rows")
+    def _ensure_sheets_have_rows(self, spreadsheet_id: str, rows_needed: Dict[str, int]) -> None:
+        """
+        values:batchUpdate won't write past the end of a sheet's grid (unlike values:append), so grow any sheet that
+        is too small in a single spreadsheets:batchUpdate
+        """
+        grid_row_counts = self._grid_row_counts.setdefault(spreadsheet_id, {})
+        if all(grid_row_counts.get(sheet, 0) >= needed for sheet, needed in rows_needed.items()):
+            return
+        result = self.sheets_client.get_spreadsheet(
+            spreadsheet_id, fields="sheets(properties(sheetId,title,gridProperties(rowCount)))"
+        )
+        dimension_requests = []
+        new_row_counts = {}
+        existing_sheets = set(sheet["properties"]["title"] for sheet in result.get("sheets", []))
+        for managed_sheet in MANAGED_SHEETS:
+            if managed_sheet in rows_needed and managed_sheet not in existing_sheets:
+                dimension_requests.append(
+                    {
+                        "addSheet": {
+                            "properties": {
+                                "title": managed_sheet,
+                                "gridProperties": {"rowCount": max(100, rows_needed[managed_sheet])},
+                            }
+                        }
+                    }
+                )
+                new_row_counts[managed_sheet] = max(100, rows_needed[managed_sheet])
+        for sheet in result.get("sheets", []):
+            properties = sheet["properties"]
+            needed = rows_needed.get(properties["title"], 0)
+            row_count = properties.get("gridProperties", {}).get("rowCount", 0)
+            new_row_counts[properties["title"]] = max(needed, row_count)
+            if needed > row_count:
+                dimension_requests.append(
+                    {
+                        "appendDimension": {
+                            "sheetId": properties["sheetId"],
+                            "dimension": "ROWS",
+                            "length": needed - row_count,
+                        }
+                    }
+                )
+        if dimension_requests:
+            self.sheets_client.batch_update(spreadsheet_id, dimension_requests)
+        grid_row_counts.update(new_row_counts)
+
+    def _batch_update_values(self, spreadsheet_id: str, data: Dict[str, List[List[str]]]) -> None:
+        body = {
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": value_range, "values": values} for value_range, values in data.items()],
+        }
+        return self.sheets_client.batch_update_values(spreadsheet_id, body)
+
+    def _get_sheet_row_counts(self, spreadsheet_id: str) -> Dict[str, int]:
+        result = self.sheets_client.get_spreadsheet(
+            spreadsheet_id, fields="sheets(properties(title,gridProperties(rowCount)))"
         )
-        result = request.execute()
-        return result
+        row_counts = {
+            sheet["properties"]["title"]: sheet["properties"].get("gridProperties", {}).get("rowCount", 0)
+            for sheet in result.get("sheets", [])
+        }
+        self._grid_row_counts.setdefault(spreadsheet_id, {}).update(row_counts)
+        return row_counts
+
+    @staticmethod
+    def _parse_row_start_ts(row: List[str]) -> Optional[int]:
+        try:
+            utc_dt = datetime.strptime(row[1], TIME_FORMAT).replace(tzinfo=timezone.utc)
+        except (IndexError, ValueError):
+            return None
+        return int(utc_dt.timestamp())
 
-    def write_new_game_data_for_team(self, team: str, match_data: List[List[str]]) -> None:
-        return self._append_data_to_sheet(spreadsheet_id=TEAM_TO_SHEET_ID[team], sheet="Overall", data=match_data)
+    @timed("sheets.read_checkpoints")
+    def _read_checkpoints(self, spreadsheet_id: str) -> Dict[str, SheetPosition]:
+        try:
+            (values,) = self._batch_get_values(spreadsheet_id, [f"{CHECKPOINT_SHEET}!A:F"])
+        except SheetsApiError as e:
+            print(f"Could not read the {CHECKPOINT_SHEET} tab, falling back to reading sheet tails {str(e)}")
+            return {}
+        self._checkpoint_row_counts[spreadsheet_id] = max(0, len(values) - 1)
+        grid_row_counts = self._grid_row_counts.setdefault(spreadsheet_id, {})
+        checkpoints = {}
+        for row in values[1:]:
+            if len(row) > 5 and row[0] and row[5].isdigit():
+                grid_row_counts[row[0]] = int(row[5])
+            try:
+                sheet, last_match_id, last_start_ts, next_row = row[0], row[1], row[2], int(row[3])
+            except (IndexError, ValueError):
+                continue
+            checkpoints[sheet] = SheetPosition(
+                sheet=sheet,
+                last_match_id=last_match_id or None,
+                next_row=next_row,
+                last_start_ts=int(last_start_ts) if last_start_ts.isdigit() else None,
+            )
+        return checkpoints
 
-    def write_new_game_data_for_player(self, player: Player, team: str, match_data: List[List[str]]) -> None:
-        return self._append_data_to_sheet(spreadsheet_id=TEAM_TO_SHEET_ID[team], sheet=player.name, data=match_data)
+    @timed("sheets.verify_checkpoints")
+    def _verify_checkpoints(
+        self, spreadsheet_id: str, checkpoints: Dict[str, SheetPosition]
+    ) -> Dict[str, SheetPosition]:
+        """
+        Checks that each checkpoint still describes the end of its sheet (e.g. nobody added or removed rows by hand)
+        by reading just the last recorded row and the row after it
+        """
+        checkpoint_list = [c for c in checkpoints.values() if c.next_row >= 2]
+        if not checkpoint_list:
+            return {}
+        ranges = [f"'{c.sheet}'!A{c.next_row - 1}:A{c.next_row}" for c in checkpoint_list]
+        verified = {}
+        for checkpoint, values in zip(checkpoint_list, self._batch_get_values(spreadsheet_id, ranges)):
+            last_row = values[0] if values else []
+            last_row_id = last_row[0] if last_row else None
+            expected_id = checkpoint.last_match_id if checkpoint.next_row > 2 else None
+            row_after_is_empty = len(values) < 2 or not any(values[1])
+            if row_after_is_empty and (last_row_id == expected_id or checkpoint.next_row == 2):
+                verified[checkpoint.sheet] = checkpoint
+            else:
+                print(f"Checkpoint for {checkpoint.sheet} is out of date, reading the end of the sheet instead")
+        return verified
 
-    def get_last_match_recorded(self, player: Player, team: str) -> Optional[str]:
+    @timed("sheets.read_tails")
+    def _read_sheet_tails(self, spreadsheet_id: str, sheets: List[str]) -> Dict[str, SheetPosition]:
+        """
+        Finds the last non-empty row of each sheet by reading windows of TAIL_WINDOW_ROWS rows backwards from the
+        end of the sheet's grid, rather than downloading the whole sheet
+        """
+        row_counts = self._get_sheet_row_counts(spreadsheet_id)
+        positions = {}
+        window_ends = {sheet: row_counts.get(sheet, 0) for sheet in sheets}
+        while window_ends:
+            windows = {}
+            for sheet, window_end in window_ends.items():
+                if window_end < 1:
+                    positions[sheet] = SheetPosition(sheet=sheet, last_match_id=None, next_row=1)
+                    continue
+                windows[sheet] = (max(1, window_end - TAIL_WINDOW_ROWS + 1), window_end)
+            if not windows:
+                break
+            ranges = [f"'{sheet}'!A{start}:B{end}" for sheet, (start, end) in windows.items()]
+            window_ends = {}
+            for (sheet, (start, end)), values in zip(windows.items(), self._batch_get_values(spreadsheet_id, ranges)):
+                last_idx = next((idx for idx in range(len(values) - 1, -1, -1) if values[idx] and values[idx][0]), None)
+                if last_idx is None:
+                    window_ends[sheet] = start - 1
+                    continue
+                last_row_number = start + last_idx
+                last_row = values[last_idx]
+                # Row 1 is the header, so a sheet with only one row has no matches recorded yet
+                has_matches = last_row_number >= 2
+                positions[sheet] = SheetPosition(
+                    sheet=sheet,
+                    last_match_id=last_row[0] if has_matches else None,
+                    next_row=last_row_number + 1,
+                    last_start_ts=self._parse_row_start_ts(last_row) if has_matches else None,
+                )
+        return positions
+
+    @timed("sheets.get_positions")
+    def get_sheet_positions(self, team: str, sheets: List[str]) -> Dict[str, SheetPosition]:
+        """
+        Finds where every given sheet currently ends. The Checkpoints tab is used when it is present and still
+        matches the sheet, otherwise only the tail of the sheet is read
+        :param team:
+        :param sheets: Sheet (tab) names, e.g. player names and "Overall"
+        :return: Mapping of sheet name to its last recorded match and next free row
+        """
         spreadsheet_id = TEAM_TO_SHEET_ID[team]
-        request = (
-            self.google_sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=player.name)
+        checkpoints = self._read_checkpoints(spreadsheet_id)
+        positions = self._verify_checkpoints(
+            spreadsheet_id, {sheet: checkpoints[sheet] for sheet in sheets if sheet in checkpoints}
         )
-        result = request.execute()
-        values = result.get("values", [])
-        if len(values) < 2:
-            return None
-        return values[-1][0]
+        missing_sheets = [sheet for sheet in sheets if sheet not in positions]
+        if missing_sheets:
+            positions.update(self._read_sheet_tails(spreadsheet_id, missing_sheets))
+        return positions
+
+    @staticmethod
+    def _get_checkpoint_sheets(positions: Dict[str, SheetPosition]) -> List[str]:
+        # The managed tabs get a row too, just to record their grid sizes
+        return list(positions) + [sheet for sheet in MANAGED_SHEETS if sheet not in positions]
+
+    def _get_checkpoint_rows(self, spreadsheet_id: str, positions: Dict[str, SheetPosition]) -> List[List[str]]:
+        updated_at = str(int(time()))
+        grid_row_counts = self._grid_row_counts.get(spreadsheet_id, {})
+        rows = [CHECKPOINT_HEADER]
+        for sheet in self._get_checkpoint_sheets(positions):
+            row_count = str(grid_row_counts.get(sheet, ""))
+            position = positions.get(sheet)
+            if position is None:
+                rows.append([sheet, "", "", "", updated_at, row_count])
+                continue
+            # A leading apostrophe keeps USER_ENTERED from turning long match IDs into rounded numbers
+            last_match_id = f"'{position.last_match_id}" if position.last_match_id else ""
+            last_start_ts = str(position.last_start_ts) if position.last_start_ts else ""
+            rows.append([sheet, last_match_id, last_start_ts, str(position.next_row), updated_at, row_count])
+        num_stale_rows = self._checkpoint_row_counts.get(spreadsheet_id, 0) - (len(rows) - 1)
+        rows.extend([[""] * len(CHECKPOINT_HEADER) for _ in range(max(0, num_stale_rows))])
+        return rows
+
+    def _write_rows_and_checkpoints(
+        self,
+        spreadsheet_id: str,
+        data: Dict[str, List[List[str]]],
+        rows_needed: Dict[str, int],
+        positions: Dict[str, SheetPosition],
+        new_positions: Dict[str, SheetPosition],
+    ) -> None:
+        """
+        Writes the rows together with the checkpoints for new_positions in one values:batchUpdate. positions is only
+        updated once that write succeeds, so a failed write leaves it describing what is actually in the sheet
+        """
+        num_checkpoints = len(self._get_checkpoint_sheets(new_positions))
+        rows_needed[CHECKPOINT_SHEET] = 1 + max(num_checkpoints, self._checkpoint_row_counts.get(spreadsheet_id, 0))
+        for attempt in range(2):
+            self._ensure_sheets_have_rows(spreadsheet_id, rows_needed)
+            # The checkpoint update rides along in the same batchUpdate as the rows it describes. It's built after
+            # growing the sheets so it records their new grid sizes
+            checkpoint_rows = self._get_checkpoint_rows(spreadsheet_id, new_positions)
+            data[f"{CHECKPOINT_SHEET}!A1:F{len(checkpoint_rows)}"] = checkpoint_rows
+            try:
+                self._batch_update_values(spreadsheet_id, data)
+                break
+            except SheetsApiError as e:
+                if e.status_code != 400 or attempt:
+                    raise
+                # A recorded grid size may be out of date (e.g. rows were deleted by hand), so fetch them and retry
+                print(f"Write failed, checking the sheet sizes and retrying {str(e)}")
+                self._grid_row_counts.pop(spreadsheet_id, None)
+        positions.update(new_positions)
+        self._checkpoint_row_counts[spreadsheet_id] = num_checkpoints
+
+    @timed("sheets.write_rows")
+    def write_new_game_data_for_sheets(
+        self,
+        team: str,
+        sheet_data: Dict[str, List[List[str]]],
+        positions: Dict[str, SheetPosition],
+        replacement_sheet_data: Optional[Dict[str, List[List[str]]]] = None,
+    ) -> None:
+        """
+        Writes rows for several sheets of a team's spreadsheet directly below their current last rows in one
+        values:batchUpdate
+        :param team:
+        :param sheet_data: Mapping of sheet name to the rows to be added to it
+        :param positions: Current positions of those sheets from get_sheet_positions
+        :param replacement_sheet_data: Mapping of sheet name to rows written from A1, e.g. the Summary tab
+        :return:
+        """
+        spreadsheet_id = TEAM_TO_SHEET_ID[team]
+        if not any(sheet_data.values()):
+            # Nothing new was played, so the Summary and Checkpoints tabs are already up to date too
+            return
+        data = {}
+        rows_needed = {}
+        for sheet, rows in sheet_data.items():
+            if not rows:
+                continue
+            start_row = positions[sheet].next_row
+            end_row = start_row + len(rows) - 1
+            data[f"'{sheet}'!A{start_row}:Z{end_row}"] = rows
+            rows_needed[sheet] = end_row
+        for sheet, rows in (replacement_sheet_data or {}).items():
+            if rows:
+                data[f"'{sheet}'!A1:Z{len(rows)}"] = rows
+                rows_needed[sheet] = len(rows)
+        new_positions = {sheet: replace(position) for sheet, position in positions.items()}
+        for sheet, rows in sheet_data.items():
+            if rows:
+                new_positions[sheet].next_row += len(rows)
+                new_positions[sheet].last_match_id = rows[-1][0]
+                new_positions[sheet].last_start_ts = self._parse_row_start_ts(rows[-1])
+
+        self._write_rows_and_checkpoints(spreadsheet_id, data, rows_needed, positions, new_positions)
+
+    @timed("sheets.read_first_rows")
+    def get_first_recorded_start_ts(self, team: str, positions: Dict[str, SheetPosition]) -> Dict[str, Optional[int]]:
+        """
+        Reads the first recorded row of each sheet, which is the oldest since rows are written in chronological order
+        :param team:
+        :param positions: Current positions of the sheets from get_sheet_positions
+        :return: Mapping of sheet name to the start timestamp of its oldest row. None if the sheet has no matches yet
+        and 0 if its first row has no readable start time, so nothing can be placed before it
+        """
+        spreadsheet_id = TEAM_TO_SHEET_ID[team]
+        first_start_ts = {sheet: None for sheet in positions}
+        sheets_with_matches = [sheet for sheet, position in positions.items() if position.next_row > 2]
+        if not sheets_with_matches:
+            return first_start_ts
+        ranges = [f"'{sheet}'!A2:B2" for sheet in sheets_with_matches]
+        for sheet, values in zip(sheets_with_matches, self._batch_get_values(spreadsheet_id, ranges)):
+            first_start_ts[sheet] = (self._parse_row_start_ts(values[0]) if values else None) or 0
+        return first_start_ts
+
+    def _get_sheet_ids(self, spreadsheet_id: str) -> Dict[str, int]:
+        result = self.sheets_client.get_spreadsheet(spreadsheet_id, fields="sheets(properties(sheetId,title))")
+        return {sheet["properties"]["title"]: sheet["properties"]["sheetId"] for sheet in result.get("sheets", [])}
+
+    @staticmethod
+    def _get_paste_data(rows: List[List[str]]) -> str:
+        # Pasted text is interpreted like typed input, the same as USER_ENTERED values
+        return "\n".join("\t".join("" if value is None else str(value) for value in row) for row in rows)
+
+    @timed("sheets.insert_rows")
+    def write_older_game_data_for_sheets(
+        self, team: str, sheet_data: Dict[str, List[List[str]]], positions: Dict[str, SheetPosition]
+    ) -> None:
+        """
+        Writes backfilled rows between each sheet's header and its first recorded row, so the sheet stays in
+        chronological order. Existing rows are shifted down and the new rows pasted into the gap in one
+        spreadsheets:batchUpdate, which either applies completely or not at all, so a failure never leaves blank rows
+        behind. The checkpoints are written afterwards; if that fails they no longer match the sheets and the next run
+        reads the sheet tails instead
+        :param team:
+        :param sheet_data: Mapping of sheet name to the rows to be added to it, oldest first. Every row must be older
+        than the sheet's first recorded row
+        :param positions: Current positions of those sheets from get_sheet_positions
+        :return:
+        """
+        spreadsheet_id = TEAM_TO_SHEET_ID[team]
+        sheet_data = {sheet: rows for sheet, rows in sheet_data.items() if rows}
+        if not sheet_data:
+            return
+        sheet_ids = self._get_sheet_ids(spreadsheet_id)
+        batch_requests = []
+        new_positions = {sheet: replace(position) for sheet, position in positions.items()}
+        for sheet, rows in sheet_data.items():
+            position = new_positions[sheet]
+            # Rows go straight after the header, which is also where a sheet without matches ends
+            start_index = min(position.next_row, 2) - 1
+            batch_requests.append(
+                {
+                    "insertDimension": {
+                        "range": {
+                            "sheetId": sheet_ids[sheet],
+                            "dimension": "ROWS",
+                            "startIndex": start_index,
+                            "endIndex": start_index + len(rows),
+                        },
+                        "inheritFromBefore": False,
+                    }
+                }
+            )
+            batch_requests.append(
+                {
+                    "pasteData": {
+                        "coordinate": {"sheetId": sheet_ids[sheet], "rowIndex": start_index, "columnIndex": 0},
+                        "data": self._get_paste_data(rows),
+                        "type": "PASTE_NORMAL",
+                        "delimiter": "\t",
+                    }
+                }
+            )
+            if position.next_row <= 2:
+                # Only a sheet that had no matches gets a new high-water mark, otherwise its newest row is unchanged
+                position.last_match_id = rows[-1][0]
+                position.last_start_ts = self._parse_row_start_ts(rows[-1])
+            position.next_row += len(rows)
+
+        self.sheets_client.batch_update(spreadsheet_id, batch_requests)
+        positions.update(new_positions)
+        grid_row_counts = self._grid_row_counts.get(spreadsheet_id, {})
+        for sheet, rows in sheet_data.items():
+            if sheet in grid_row_counts:
+                grid_row_counts[sheet] += len(rows)
+
+        self._write_rows_and_checkpoints(spreadsheet_id, {}, {}, positions, positions)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+from enum import Enum
+from typing import Optional, Dict, Any, List, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Response headers worth keeping in a fixture. Everything else (cookies, dates, tracing ids) only adds noise
+RECORDED_HEADERS = ("Content-Type", "Retry-After", "ETag", "Last-Modified")
+
+
+class FixtureMode(Enum):
+    OFF = "off"
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+class FixtureNotFoundError(requests.RequestException):
+    pass
+
+
+class FixtureCorpus:
+    """
+    Directory of recorded HTTP exchanges, one JSON file per distinct request holding every response it got, in order.
+    Each exchange is saved under a key for the exact request (method, URL, params and body) and under a looser key for
+    just the method and URL, so requests whose bodies change between runs (e.g. Sheets writes carrying a timestamp)
+    still replay. Replaying a request returns its responses in the order they were recorded and then keeps returning
+    the last one, so reads of something that changed during the recording (e.g. a sheet's rows) replay correctly
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._replay_counts: Dict[str, int] = {}
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _get_keys(method: str, url: str, params: Any = None, body: Any = None) -> Tuple[str, str]:
+        request = json.dumps([method.upper(), url, params], sort_keys=True, default=str)
+        exact = hashlib.sha1((request + json.dumps(body, sort_keys=True, default=str)).encode("utf-8")).hexdigest()
+        loose = hashlib.sha1(json.dumps([method.upper(), url]).encode("utf-8")).hexdigest()
+        return exact, loose
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def _read_exchanges(self, key: str) -> List[Dict[str, Any]]:
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, method: str, url: str, params: Any, body: Any, resp: requests.Response) -> None:
+        exchange = {
+            "method": method.upper(),
+            "url": url,
+            "params": params,
+            "status_code": resp.status_code,
+            "headers": {name: resp.headers[name] for name in RECORDED_HEADERS if name in resp.headers},
+            "body": resp.content.decode("utf-8", errors="replace"),
+        }
+        with self._lock:
+            for key in self._get_keys(method, url, params, body):
+                exchanges = self._read_exchanges(key)
+                exchanges.append(exchange)
+                with open(self._get_path(key), "w") as f:
+                    json.dump(exchanges, f)
+
+    def load(self, method: str, url: str, params: Any = None, body: Any = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for key in self._get_keys(method, url, params, body):
+                exchanges = self._read_exchanges(key)
+                if exchanges:
+                    replay_count = self._replay_counts.get(key, 0)
+                    self._replay_counts[key] = replay_count + 1
+                    return exchanges[min(replay_count, len(exchanges) - 1)]
+        return None
+
+
+class RecordingSession:
+    """
+    Wraps a requests session and saves every response it gets into a FixtureCorpus
+    """
+
+    def __init__(self, session: requests.Session, corpus: FixtureCorpus):
+        self.session = session
+        self.corpus = corpus
+
+    def mount(self, prefix, adapter) -> None:
+        self.session.mount(prefix, adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        resp = self.session.request(method, url, **kwargs)
+        self.corpus.save(method, url, kwargs.get("params"), kwargs.get("json"), resp)
+        return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+
+class ReplaySession:
+    """
+    Stands in for a requests session by answering from a FixtureCorpus. Requests that were never recorded raise
+    FixtureNotFoundError, which isn't retried
+    """
+
+    def __init__(self, corpus: FixtureCorpus):
+        self.corpus = corpus
+
+    def mount(self, prefix, adapter) -> None:
+        pass
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        exchange = self.corpus.load(method, url, kwargs.get("params"), kwargs.get("json"))
+        if exchange is None:
+            raise FixtureNotFoundError(f"No recorded response for {method.upper()} {url}")
+        resp = requests.Response()
+        resp.status_code = exchange["status_code"]
+        resp.headers = CaseInsensitiveDict(exchange["headers"])
+        resp._content = exchange["body"].encode("utf-8")
+        resp.encoding = "utf-8"
+        resp.url = url
+        resp.reason = ""
+        return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+
+_fixture_mode = FixtureMode.OFF
+_fixture_corpus: Optional[FixtureCorpus] = None
+
+
+def configure_fixtures(mode: FixtureMode, path: Optional[str] = None) -> None:
+    """
+    Makes every session created afterwards by HttpTransport and SheetsRestClient record to, or replay from, the
+    fixture corpus at path
+    """
+    global _fixture_mode, _fixture_corpus
+    _fixture_mode = mode
+    _fixture_corpus = FixtureCorpus(path) if mode != FixtureMode.OFF else None
+
+
+def is_replaying() -> bool:
+    return _fixture_mode == FixtureMode.REPLAY
+
+
+def wrap_session(session):
+    if _fixture_mode == FixtureMode.RECORD:
+        return RecordingSession(session, _fixture_corpus)
+    if _fixture_mode == FixtureMode.REPLAY:
+        return ReplaySession(_fixture_corpus)
+    return session
@@ -0,0 +1,159 @@
+import random
+import threading
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import sleep
+from typing import Optional, Dict, Tuple, Any
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import (
+    HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT_SEC,
+    HTTP_READ_TIMEOUT_SEC,
+    HTTP_MAX_RETRIES,
+    HTTP_BACKOFF_BASE_SEC,
+    HTTP_BACKOFF_MAX_SEC,
+    HTTP_DEFAULT_ENDPOINT_CONCURRENCY,
+    HTTP_ENDPOINT_CONCURRENCY,
+)
+from external_services.http_fixtures import wrap_session
+from utils.instrumentation import count, timer
+from utils.rate_limiter import TokenBucketRateLimiter
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HttpTransport:
+    """
+    Keep-alive connection pool shared by every call a scraper makes.
+    Requests are retried with exponential backoff (honoring Retry-After) on 429s, 5xxs, timeouts and dropped
+    connections, and each named endpoint has its own cap on in-flight requests.
+    Validators (ETag / Last-Modified) from conditional requests are kept per URL, so polling a resource that hasn't
+    changed costs a 304 with no body.
+    """
+
+    def __init__(
+        self,
+        rate_limiter: Optional[TokenBucketRateLimiter] = None,
+        timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC),
+        max_retries: int = HTTP_MAX_RETRIES,
+        backoff_base_sec: float = HTTP_BACKOFF_BASE_SEC,
+        backoff_max_sec: float = HTTP_BACKOFF_MAX_SEC,
+        pool_size: int = HTTP_POOL_SIZE,
+        endpoint_concurrency: Optional[Dict[str, int]] = None,
+        session: Optional[requests.Session] = None,
+    ):
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = wrap_session(session)
+
+        concurrency_limits = dict(HTTP_ENDPOINT_CONCURRENCY)
+        concurrency_limits.update(endpoint_concurrency or {})
+        self._endpoint_semaphores: Dict[str, threading.BoundedSemaphore] = defaultdict(
+            lambda: threading.BoundedSemaphore(HTTP_DEFAULT_ENDPOINT_CONCURRENCY)
+        )
+        for endpoint, limit in concurrency_limits.items():
+            self._endpoint_semaphores[endpoint] = threading.BoundedSemaphore(limit)
+        self._semaphore_lock = threading.Lock()
+        # (url, params) -> (ETag, Last-Modified) of the last response to a conditional request
+        self._validators: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str]]] = {}
+        self._validators_lock = threading.Lock()
+
+    def _get_endpoint_semaphore(self, endpoint: str) -> threading.BoundedSemaphore:
+        with self._semaphore_lock:
+            return self._endpoint_semaphores[endpoint]
+
+    def _get_backoff_delay(self, attempt: int) -> float:
+        delay = min(self.backoff_max_sec, self.backoff_base_sec * (2**attempt))
+        # Full jitter so concurrent workers don't retry in lockstep
+        return random.uniform(0, delay)
+
+    def _get_retry_after_delay(self, resp: requests.Response) -> Optional[float]:
+        retry_after = resp.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        if retry_after.isdigit():
+            return float(retry_after)
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+    def get(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        """
+        Performs a GET, retrying transient failures. Raises the last error once retries are exhausted
+        :param endpoint: Name used to pick the concurrency limit for this request (e.g. "match", "profile")
+        :param url:
+        :param kwargs: Passed through to requests.Session.get
+        :return:
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        semaphore = self._get_endpoint_semaphore(endpoint)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                with timer("http.rate_limit_wait", endpoint):
+                    self.rate_limiter.acquire()
+            is_last_attempt = attempt == self.max_retries
+            try:
+                count("http_requests", endpoint)
+                with semaphore:
+                    with timer("http.request", endpoint):
+                        resp = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                count("http_errors", endpoint)
+                if is_last_attempt:
+                    raise
+                delay = self._get_backoff_delay(attempt)
+                print(f"Request to {endpoint} failed with {str(e)}, retrying in {round(delay, 2)}s")
+            else:
+                count("http_bytes", endpoint, len(resp.content))
+                if resp.status_code not in RETRYABLE_STATUS_CODES or is_last_attempt:
+                    resp.raise_for_status()
+                    return resp
+                count(f"http_status_{resp.status_code}", endpoint)
+                retry_after_delay = self._get_retry_after_delay(resp)
+                delay = retry_after_delay if retry_after_delay is not None else self._get_backoff_delay(attempt)
+                print(f"Request to {endpoint} returned {resp.status_code}, retrying in {round(delay, 2)}s")
+            count("http_retries", endpoint)
+            with timer("http.backoff_sleep", endpoint):
+                sleep(delay)
+
+    @staticmethod
+    def _get_validators_key(url: str, params: Any) -> Tuple[str, str]:
+        return url, repr(sorted(params.items()) if isinstance(params, dict) else params)
+
+    def get_if_changed(self, endpoint: str, url: str, **kwargs) -> Optional[requests.Response]:
+        """
+        Same as get, but sends If-None-Match / If-Modified-Since from the last response to this URL and params
+        :return: None if the server answered 304 Not Modified
+        """
+        validators_key = self._get_validators_key(url, kwargs.get("params"))
+        with self._validators_lock:
+            etag, last_modified = self._validators.get(validators_key, (None, None))
+        headers = dict(kwargs.pop("headers", None) or {})
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        resp = self.get(endpoint, url, headers=headers, **kwargs)
+        if resp.status_code == 304:
+            count("http_not_modified", endpoint)
+            return None
+        if resp.headers.get("ETag") or resp.headers.get("Last-Modified"):
+            with self._validators_lock:
+                self._validators[validators_key] = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+        return resp
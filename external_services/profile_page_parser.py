@@ -0,0 +1,78 @@
+import importlib.util
+from typing import Optional, List
+
+from bs4 import BeautifulSoup
+
+PARSER_BACKEND = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+L7D_MARKER = "Last 7 Days"
+KD_RATIO_NAME = "K/D Ratio"
+# How much of the page around the "Last 7 Days" marker to parse. The section's enclosing tags start shortly before
+# the marker and its stats follow it
+FRAGMENT_CHARS_BEFORE = 2048
+FRAGMENT_CHARS_AFTER = 16384
+MAX_MARKERS_TRIED = 3
+
+
+def _find_last_7d_kd_ratio(soup: BeautifulSoup) -> Optional[float]:
+    l7d_tag = soup.find(string=L7D_MARKER)
+    if not l7d_tag or not l7d_tag.parent or not l7d_tag.parent.parent:
+        return None
+    last_7d_games_played = l7d_tag.parent.parent
+    for numbers in last_7d_games_played.find_all("div", class_="numbers"):
+        name = numbers.find("span", class_="name")
+        value = numbers.find("span", class_="value")
+        if name and value and name.text == KD_RATIO_NAME:
+            try:
+                return float(value.text)
+            except ValueError:
+                return None
+    return None
+
+
+def parse_last_7d_kd_ratio_full_page(html: str) -> Optional[float]:
+    return _find_last_7d_kd_ratio(BeautifulSoup(html, PARSER_BACKEND))
+
+
+def get_last_7d_fragments(html: str) -> List[str]:
+    """
+    Cuts out the small pieces of a profile page around its first few "Last 7 Days" markers. This is only string
+    searching, so it's cheap enough to do before handing the fragments to another process to parse
+    :param html:
+    :return: The fragments, empty if the marker isn't on the page at all
+    """
+    fragments = []
+    search_start = 0
+    for _ in range(MAX_MARKERS_TRIED):
+        marker_idx = html.find(L7D_MARKER, search_start)
+        if marker_idx == -1:
+            break
+        fragment_start = html.find("<", max(0, marker_idx - FRAGMENT_CHARS_BEFORE))
+        fragments.append(html[fragment_start : marker_idx + FRAGMENT_CHARS_AFTER])
+        search_start = marker_idx + len(L7D_MARKER)
+    return fragments
+
+
+def parse_last_7d_kd_ratio_from_fragments(fragments: List[str]) -> Optional[float]:
+    """
+    This is a module-level function so it can be submitted to a ProcessPoolExecutor
+    """
+    for fragment in fragments:
+        kd = _find_last_7d_kd_ratio(BeautifulSoup(fragment, PARSER_BACKEND))
+        if kd is not None:
+            return kd
+    return None
+
+
+def parse_last_7d_kd_ratio(html: str) -> Optional[float]:
+    """
+    Reads the last 7 day K/D from a cod.tracker.gg profile page. Only a small fragment around the "Last 7 Days"
+    section is parsed; the whole page is parsed only if none of the fragments contain the stat
+    :param html:
+    :return:
+    """
+    fragments = get_last_7d_fragments(html)
+    if not fragments:
+        return None
+    kd = parse_last_7d_kd_ratio_from_fragments(fragments)
+    return kd if kd is not None else parse_last_7d_kd_ratio_full_page(html)
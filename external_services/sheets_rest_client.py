@@ -0,0 +1,97 @@
+import urllib.parse
+from typing import Optional, Dict, Any, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from external_services.http_fixtures import wrap_session
+from utils.instrumentation import count, timer
+
+from constants import (
+    SHEETS_API_BASE_URL,
+    SHEETS_HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT_SEC,
+    HTTP_READ_TIMEOUT_SEC,
+)
+
+# The handful of Sheets v4 methods this app uses, as (HTTP method, path) pairs taken from the discovery document.
+# Keeping them here means no discovery document has to be fetched or parsed at startup
+SHEETS_METHODS = {
+    "spreadsheets.get": ("GET", "v4/spreadsheets/{spreadsheetId}"),
+    "spreadsheets.batchUpdate": ("POST", "v4/spreadsheets/{spreadsheetId}:batchUpdate"),
+    "spreadsheets.values.batchGet": ("GET", "v4/spreadsheets/{spreadsheetId}/values:batchGet"),
+    "spreadsheets.values.batchUpdate": ("POST", "v4/spreadsheets/{spreadsheetId}/values:batchUpdate"),
+}
+
+
+class SheetsApiError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Sheets API returned {status_code}: {message}")
+        self.status_code = status_code
+
+
+class SheetsRestClient:
+    """
+    Calls the Sheets v4 REST API directly over one pooled session. With credentials the session is an
+    AuthorizedSession, which reuses the access token and only refreshes it when it expires. Without credentials
+    (e.g. against a local fake server) a plain session is used
+    """
+
+    def __init__(
+        self,
+        credentials=None,
+        base_url: str = SHEETS_API_BASE_URL,
+        timeout: Tuple[float, float] = (HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC),
+        pool_size: int = SHEETS_HTTP_POOL_SIZE,
+        session: Optional[requests.Session] = None,
+    ):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.timeout = timeout
+        if session is None:
+            if credentials is not None:
+                from google.auth.transport.requests import AuthorizedSession
+
+                session = AuthorizedSession(credentials)
+            else:
+                session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = wrap_session(session)
+
+    def _call(self, method_name: str, path_params: Dict[str, str], params=None, body=None) -> Dict[str, Any]:
+        http_method, path = SHEETS_METHODS[method_name]
+        url = self.base_url + path.format(
+            **{name: urllib.parse.quote(value, safe="") for name, value in path_params.items()}
+        )
+        with timer("sheets.request", method_name):
+            count("sheets_requests", method_name)
+            resp = self.session.request(http_method, url, params=params, json=body, timeout=self.timeout)
+        count("sheets_bytes", method_name, len(resp.content))
+        if resp.status_code >= 400:
+            count("sheets_errors", method_name)
+            try:
+                message = resp.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = resp.text
+            raise SheetsApiError(resp.status_code, message)
+        return resp.json() if resp.content else {}
+
+    def get_spreadsheet(self, spreadsheet_id: str, fields: Optional[str] = None) -> Dict[str, Any]:
+        params = {"fields": fields} if fields else None
+        return self._call("spreadsheets.get", {"spreadsheetId": spreadsheet_id}, params=params)
+
+    def batch_update(self, spreadsheet_id: str, batch_requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return self._call(
+            "spreadsheets.batchUpdate", {"spreadsheetId": spreadsheet_id}, body={"requests": batch_requests}
+        )
+
+    def batch_get_values(self, spreadsheet_id: str, ranges: List[str], major_dimension: str = "ROWS") -> Dict[str, Any]:
+        return self._call(
+            "spreadsheets.values.batchGet",
+            {"spreadsheetId": spreadsheet_id},
+            params={"ranges": ranges, "majorDimension": major_dimension},
+        )
+
+    def batch_update_values(self, spreadsheet_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        return self._call("spreadsheets.values.batchUpdate", {"spreadsheetId": spreadsheet_id}, body=body)
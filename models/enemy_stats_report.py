@@ -0,0 +1,21 @@
+from dataclasses import dataclass, field
+from typing import List, Dict
+
+
+@dataclass
+class EnemyStatsReport:
+    match_id: str
+    team_count: int
+    total_players: int = 0
+    skipped_players: int = 0
+    # Average K/D of each team with data, ordered by placement
+    team_avg_kd: List[float] = field(default_factory=list)
+    player_kds: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class EnemyStatsSessionReport:
+    match_reports: List[EnemyStatsReport]
+    distinct_players: int = 0
+    # Players who showed up in more than one of the session's lobbies
+    repeat_players: int = 0
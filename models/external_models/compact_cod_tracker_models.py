@@ -0,0 +1,148 @@
+from array import array
+from typing import List, NamedTuple, Optional, Iterator, Iterable, Union
+
+from models.external_models.cod_tracker_models import (
+    WarzoneMatch,
+    WarzoneMatchMetadata,
+    WarzonePlayerData,
+    WarzonePlayerStats,
+)
+
+# Signed 32-bit integers; damage and time played can exceed 16 bits
+INT_COLUMN_TYPECODE = "i"
+# team_placement is Optional, so None is stored as 0 (placements start at 1)
+MISSING_PLACEMENT = 0
+
+STAT_COLUMNS = ("damage_done", "deaths", "gulag_deaths", "gulag_kills", "kills", "team_placement", "time_played_sec")
+
+
+class FrozenWarzoneMatchMetadata(NamedTuple):
+    mode_name: str
+    start_time_ts: int
+    player_count: int
+    team_count: int
+    match_id: str
+
+
+class FrozenWarzonePlayerStats(NamedTuple):
+    damage_done: int = 0
+    deaths: int = 0
+    gulag_deaths: int = 0
+    gulag_kills: int = 0
+    kills: int = 0
+    team_placement: Optional[int] = None
+    time_played_sec: int = 0
+
+
+class FrozenWarzonePlayerData(NamedTuple):
+    gamertag: str
+    stats: FrozenWarzonePlayerStats
+
+
+class WarzoneLobbyColumns:
+    """
+    Column-oriented store of the players in a match: one list of gamertags plus one typed array per stat.
+    Iterating or indexing returns FrozenWarzonePlayerData, so code written against WarzoneMatch.players still works,
+    while aggregate code can read whole columns (e.g. `columns.kills`) without creating per-player objects
+    """
+
+    __slots__ = ("gamertags",) + STAT_COLUMNS
+
+    def __init__(self, gamertags: Optional[List[str]] = None, **stat_columns: Iterable[int]):
+        self.gamertags: List[str] = list(gamertags) if gamertags else []
+        for column in STAT_COLUMNS:
+            values = stat_columns.get(column)
+            if values is None:
+                values = [0] * len(self.gamertags)
+            setattr(self, column, array(INT_COLUMN_TYPECODE, values))
+
+    @classmethod
+    def from_players(
+        cls, players: Iterable[Union[WarzonePlayerData, FrozenWarzonePlayerData]]
+    ) -> "WarzoneLobbyColumns":
+        columns = cls()
+        for player in players:
+            columns.append(player.gamertag, player.stats)
+        return columns
+
+    def append(self, gamertag: str, stats: Union[WarzonePlayerStats, FrozenWarzonePlayerStats]) -> None:
+        self.gamertags.append(gamertag)
+        self.damage_done.append(stats.damage_done)
+        self.deaths.append(stats.deaths)
+        self.gulag_deaths.append(stats.gulag_deaths)
+        self.gulag_kills.append(stats.gulag_kills)
+        self.kills.append(stats.kills)
+        self.team_placement.append(MISSING_PLACEMENT if stats.team_placement is None else stats.team_placement)
+        self.time_played_sec.append(stats.time_played_sec)
+
+    def __len__(self) -> int:
+        return len(self.gamertags)
+
+    def __getitem__(self, idx: int) -> FrozenWarzonePlayerData:
+        team_placement = self.team_placement[idx]
+        return FrozenWarzonePlayerData(
+            gamertag=self.gamertags[idx],
+            stats=FrozenWarzonePlayerStats(
+                damage_done=self.damage_done[idx],
+                deaths=self.deaths[idx],
+                gulag_deaths=self.gulag_deaths[idx],
+                gulag_kills=self.gulag_kills[idx],
+                kills=self.kills[idx],
+                team_placement=None if team_placement == MISSING_PLACEMENT else team_placement,
+                time_played_sec=self.time_played_sec[idx],
+            ),
+        )
+
+    def __iter__(self) -> Iterator[FrozenWarzonePlayerData]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def select(self, indices: Iterable[int]) -> "WarzoneLobbyColumns":
+        indices = list(indices)
+        return WarzoneLobbyColumns(
+            gamertags=[self.gamertags[idx] for idx in indices],
+            **{column: [getattr(self, column)[idx] for idx in indices] for column in STAT_COLUMNS},
+        )
+
+    def indices_for_team(self, team_placement: int) -> List[int]:
+        return [idx for idx, placement in enumerate(self.team_placement) if placement == team_placement]
+
+
+class CompactWarzoneMatch:
+    """
+    Memory-light, read-only counterpart of WarzoneMatch
+    """
+
+    __slots__ = ("metadata", "players")
+
+    def __init__(self, metadata: FrozenWarzoneMatchMetadata, players: WarzoneLobbyColumns):
+        self.metadata = metadata
+        self.players = players
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CompactWarzoneMatch):
+            return NotImplemented
+        return self.metadata == other.metadata and list(self.players) == list(other.players)
+
+    @classmethod
+    def from_warzone_match(cls, warzone_match: WarzoneMatch) -> "CompactWarzoneMatch":
+        metadata = warzone_match.metadata
+        return cls(
+            metadata=FrozenWarzoneMatchMetadata(
+                mode_name=metadata.mode_name,
+                start_time_ts=metadata.start_time_ts,
+                player_count=metadata.player_count,
+                team_count=metadata.team_count,
+                match_id=metadata.match_id,
+            ),
+            players=WarzoneLobbyColumns.from_players(warzone_match.players),
+        )
+
+    def to_warzone_match(self) -> WarzoneMatch:
+        return WarzoneMatch(
+            metadata=WarzoneMatchMetadata(**self.metadata._asdict()),
+            players=[
+                WarzonePlayerData(gamertag=player.gamertag, stats=WarzonePlayerStats(**player.stats._asdict()))
+                for player in self.players
+            ],
+        )
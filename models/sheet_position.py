@@ -0,0 +1,11 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class SheetPosition:
+    sheet: str
+    last_match_id: Optional[str]
+    # 1-indexed row the next appended row should be written to
+    next_row: int
+    last_start_ts: Optional[int] = None
@@ -0,0 +1,175 @@
+import json
+from typing import Dict, Any, Union, Optional, Iterator, Tuple
+
+from models.external_models.cod_tracker_models import (
+    WarzoneMatchMetadata,
+    WarzonePlayerStats,
+    WarzonePlayerData,
+    WarzoneMatch,
+)
+from models.external_models.compact_cod_tracker_models import (
+    CompactWarzoneMatch,
+    FrozenWarzoneMatchMetadata,
+    WarzoneLobbyColumns,
+    MISSING_PLACEMENT,
+)
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# (tracker.gg stat name, WarzonePlayerStats field), precomputed so decoding never converts names per call
+STAT_FIELD_MAP = (
+    ("kills", "kills"),
+    ("gulagKills", "gulag_kills"),
+    ("gulagDeaths", "gulag_deaths"),
+    ("damageDone", "damage_done"),
+    ("deaths", "deaths"),
+    ("timePlayed", "time_played_sec"),
+    ("teamPlacement", "team_placement"),
+)
+
+
+class MatchDecodeError(ValueError):
+    pass
+
+
+def load_json(content: Union[bytes, str]) -> Any:
+    """
+    Parses a JSON body, using orjson when it is installed
+    """
+    return _json_loads(content)
+
+
+def decode_warzone_player_stats(stats: Dict[str, Any]) -> WarzonePlayerStats:
+    stat_values = {}
+    for stat_name, field_name in STAT_FIELD_MAP:
+        try:
+            stat_values[field_name] = int(stats[stat_name]["value"])
+        except KeyError:
+            print(f"Caught KeyError reading {stat_name} from stat dictionary")
+            stat_values[field_name] = 0
+    return WarzonePlayerStats(**stat_values)
+
+
+def decode_warzone_player(segment: Dict[str, Any]) -> WarzonePlayerData:
+    return WarzonePlayerData(
+        gamertag=str(segment["metadata"]["platformUserHandle"]),
+        stats=decode_warzone_player_stats(segment["stats"]),
+    )
+
+
+def decode_warzone_match_metadata(data: Dict[str, Any]) -> WarzoneMatchMetadata:
+    metadata = data["metadata"]
+    return WarzoneMatchMetadata(
+        mode_name=str(metadata["modeName"]),
+        start_time_ts=int(metadata["timestamp"]),
+        player_count=int(metadata["playerCount"]),
+        team_count=int(metadata["teamCount"]),
+        match_id=str(data["attributes"]["id"]),
+    )
+
+
+def decode_warzone_match(data: Dict[str, Any]) -> WarzoneMatch:
+    """
+    Builds a WarzoneMatch straight from the "data" object of a MATCH_DATA_URL response. Produces the same objects
+    as WARZONE_MATCH_SCHEMA.load without marshmallow's per-field machinery, and without modifying `data`
+    :param data:
+    :return:
+    """
+    try:
+        return WarzoneMatch(
+            metadata=decode_warzone_match_metadata(data),
+            players=[decode_warzone_player(segment) for segment in data["segments"]],
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise MatchDecodeError(f"Could not decode match data: {repr(e)}") from e
+
+
+def decode_compact_warzone_match(data: Dict[str, Any]) -> CompactWarzoneMatch:
+    """
+    Like decode_warzone_match, but appends each player's stats straight into typed columns without building
+    per-player objects
+    :param data:
+    :return:
+    """
+    try:
+        metadata = decode_warzone_match_metadata(data)
+        segments = data["segments"]
+        gamertags = [str(segment["metadata"]["platformUserHandle"]) for segment in segments]
+        stat_columns = {field_name: [] for _, field_name in STAT_FIELD_MAP}
+        for segment in segments:
+            stats = segment["stats"]
+            for stat_name, field_name in STAT_FIELD_MAP:
+                try:
+                    stat_columns[field_name].append(int(stats[stat_name]["value"]))
+                except KeyError:
+                    print(f"Caught KeyError reading {stat_name} from stat dictionary")
+                    stat_columns[field_name].append(MISSING_PLACEMENT if field_name == "team_placement" else 0)
+    except (KeyError, TypeError, ValueError) as e:
+        raise MatchDecodeError(f"Could not decode match data: {repr(e)}") from e
+
+    return CompactWarzoneMatch(
+        metadata=FrozenWarzoneMatchMetadata(**vars(metadata)),
+        players=WarzoneLobbyColumns(gamertags=gamertags, **stat_columns),
+    )
+
+
+def get_mode_name(data: Dict[str, Any]) -> Optional[str]:
+    try:
+        return data["metadata"]["modeName"]
+    except (KeyError, TypeError):
+        return None
+
+
+def _get_segment_team_placement(segment: Dict[str, Any]) -> Optional[int]:
+    try:
+        return int(segment["stats"]["teamPlacement"]["value"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def decode_allied_warzone_match(data: Dict[str, Any], gamertag: str) -> Optional[WarzoneMatch]:
+    """
+    Decodes a match keeping only the players on `gamertag`'s team. The team placement is read from the raw
+    segments first so the rest of the lobby is never turned into objects
+    :param data:
+    :param gamertag:
+    :return: None if the player isn't in the match
+    """
+    try:
+        segments = data["segments"]
+        player_segment = next(
+            (segment for segment in segments if segment["metadata"]["platformUserHandle"] == gamertag), None
+        )
+        if player_segment is None:
+            return None
+        team_placement = _get_segment_team_placement(player_segment)
+        allied_segments = [segment for segment in segments if _get_segment_team_placement(segment) == team_placement]
+        return WarzoneMatch(
+            metadata=decode_warzone_match_metadata(data),
+            players=[decode_warzone_player(segment) for segment in allied_segments],
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise MatchDecodeError(f"Could not decode match data: {repr(e)}") from e
+
+
+def iter_player_appearances(data: Dict[str, Any]) -> Iterator[Tuple[str, int, int, Optional[int]]]:
+    """
+    Yields (gamertag, kills, deaths, team placement) for every player in a raw match payload, skipping malformed
+    segments
+    """
+    for segment in data.get("segments", []):
+        try:
+            stats = segment["stats"]
+            yield (
+                str(segment["metadata"]["platformUserHandle"]),
+                int(stats["kills"]["value"]),
+                int(stats["deaths"]["value"]),
+                _get_segment_team_placement(segment),
+            )
+        except (KeyError, TypeError, ValueError):
+            continue
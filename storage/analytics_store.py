@@ -0,0 +1,177 @@
+import sqlite3
+import threading
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+from constants import ANALYTICS_STORE_PATH
+from models.external_models.cod_tracker_models import WarzonePlayerStats
+
+GROUP_BY_COLUMNS = {"player": "player", "roster": "roster", "mode": "mode"}
+
+
+class AnalyticsStore:
+    """
+    Local SQLite copy of every row written to the player sheets, indexed for ad-hoc queries over match history
+    without going through the Sheets API
+    """
+
+    def __init__(self, db_path: str = ANALYTICS_STORE_PATH):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS player_matches (
+                    player TEXT NOT NULL,
+                    match_id TEXT NOT NULL,
+                    start_time INTEGER NOT NULL,
+                    mode TEXT NOT NULL,
+                    roster TEXT NOT NULL,
+                    team_placement INTEGER,
+                    kills INTEGER NOT NULL,
+                    deaths INTEGER NOT NULL,
+                    damage_done INTEGER NOT NULL,
+                    gulag_kills INTEGER NOT NULL,
+                    gulag_deaths INTEGER NOT NULL,
+                    time_played_sec INTEGER NOT NULL,
+                    PRIMARY KEY (player, match_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_player_matches_player_start_time
+                    ON player_matches (player, start_time);
+                CREATE INDEX IF NOT EXISTS idx_player_matches_match_id ON player_matches (match_id);
+                CREATE INDEX IF NOT EXISTS idx_player_matches_mode ON player_matches (mode);
+                CREATE INDEX IF NOT EXISTS idx_player_matches_roster ON player_matches (roster);
+                """
+            )
+
+    def record_player_matches(
+        self, player: str, matches: Iterable[Tuple[str, int, str, str, WarzonePlayerStats]]
+    ) -> None:
+        """
+        Inserts (or replaces) one row per match for a player
+        :param player: The player's name as used for their sheet
+        :param matches: (match_id, start_time_ts, mode_name, roster, stats) tuples
+        :return:
+        """
+        rows = [
+            (
+                player,
+                match_id,
+                start_time_ts,
+                mode_name,
+                roster,
+                stats.team_placement,
+                stats.kills,
+                stats.deaths,
+                stats.damage_done,
+                stats.gulag_kills,
+                stats.gulag_deaths,
+                stats.time_played_sec,
+            )
+            for match_id, start_time_ts, mode_name, roster, stats in matches
+        ]
+        if not rows:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO player_matches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    @staticmethod
+    def _build_filters(
+        player: Optional[str], roster: Optional[str], mode: Optional[str], since_ts: Optional[int]
+    ) -> Tuple[str, List[Any]]:
+        clauses, params = [], []
+        for column, value in (("player", player), ("roster", roster), ("mode", mode)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since_ts is not None:
+            clauses.append("start_time >= ?")
+            params.append(since_ts)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def get_rolling_kd(
+        self, player: str, window: int = 20, mode: Optional[str] = None, roster: Optional[str] = None
+    ) -> Optional[float]:
+        """
+        K/D over a player's most recent `window` matches (optionally only in a mode or with a roster)
+        """
+        where, params = self._build_filters(player, roster, mode, None)
+        query = (
+            "SELECT SUM(kills), SUM(deaths) FROM ("
+            f"SELECT kills, deaths FROM player_matches{where} ORDER BY start_time DESC LIMIT ?)"
+        )
+        with self._lock:
+            kills, deaths = self._connection.execute(query, params + [window]).fetchone()
+        if kills is None:
+            return None
+        return round(kills / max(deaths, 1), 2)
+
+    def get_win_rate(
+        self,
+        player: Optional[str] = None,
+        roster: Optional[str] = None,
+        mode: Optional[str] = None,
+        since_ts: Optional[int] = None,
+    ) -> Optional[float]:
+        return self._get_placement_rate(1, player, roster, mode, since_ts)
+
+    def get_top_five_rate(
+        self,
+        player: Optional[str] = None,
+        roster: Optional[str] = None,
+        mode: Optional[str] = None,
+        since_ts: Optional[int] = None,
+    ) -> Optional[float]:
+        return self._get_placement_rate(5, player, roster, mode, since_ts)
+
+    def _get_placement_rate(
+        self,
+        max_placement: int,
+        player: Optional[str],
+        roster: Optional[str],
+        mode: Optional[str],
+        since_ts: Optional[int],
+    ) -> Optional[float]:
+        where, params = self._build_filters(player, roster, mode, since_ts)
+        # Without a player filter every roster member has a row per match, so count distinct matches instead.
+        # Matches without a known placement are stored as 0 or NULL and never count as placing
+        query = (
+            "SELECT COUNT(DISTINCT match_id), "
+            "COUNT(DISTINCT CASE WHEN team_placement > 0 AND team_placement <= ? THEN match_id END) "
+            f"FROM player_matches{where}"
+        )
+        with self._lock:
+            games, placed = self._connection.execute(query, [max_placement] + params).fetchone()
+        if not games:
+            return None
+        return round(placed / games, 4)
+
+    def get_summary(
+        self, group_by: str = "player", mode: Optional[str] = None, since_ts: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Games played, K/D, win rate and top five rate per player, roster or mode
+        """
+        if group_by not in GROUP_BY_COLUMNS:
+            raise ValueError(f"group_by must be one of {list(GROUP_BY_COLUMNS)}")
+        column = GROUP_BY_COLUMNS[group_by]
+        where, params = self._build_filters(None, None, mode, since_ts)
+        query = (
+            f"SELECT {column}, COUNT(DISTINCT match_id), SUM(kills), SUM(deaths), "
+            "COUNT(DISTINCT CASE WHEN team_placement = 1 THEN match_id END), "
+            "COUNT(DISTINCT CASE WHEN team_placement > 0 AND team_placement <= 5 THEN match_id END) "
+            f"FROM player_matches{where} GROUP BY {column} ORDER BY {column}"
+        )
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [
+            {
+                group_by: key,
+                "games": games,
+                "kd": round(kills / max(deaths, 1), 2),
+                "win_rate": round(wins / games, 4),
+                "top_five_rate": round(top_fives / games, 4),
+            }
+            for key, games, kills, deaths, wins, top_fives in rows
+        ]
@@ -0,0 +1,102 @@
+import json
+import os.path
+import threading
+from collections import OrderedDict, Counter
+from time import time
+from typing import Any, Tuple, Dict
+
+from constants import LOOKUP_CACHE_PATH, LOOKUP_CACHE_MAX_ENTRIES
+from utils.instrumentation import count
+
+
+class LookupCache:
+    """
+    Bounded LRU cache with per-entry TTLs, persisted as an append-only JSON lines file.
+    Entries are grouped by namespace (e.g. "activision_id", "l7d_kd") so hit/miss counts can be reported per lookup.
+    Later lines in the file win, and the file is compacted on load once it holds mostly stale lines.
+    """
+
+    def __init__(self, path: str = LOOKUP_CACHE_PATH, max_entries: int = LOOKUP_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        num_lines = 0
+        now = time()
+        with open(self.path, "r") as cache_file:
+            for line in cache_file:
+                line = line.strip()
+                if not line:
+                    continue
+                num_lines += 1
+                try:
+                    entry = json.loads(line)
+                    key = (entry["namespace"], entry["key"])
+                    value, expires_at = entry["value"], entry["expires_at"]
+                except (ValueError, KeyError):
+                    print(f"Skipping malformed line in {self.path}")
+                    continue
+                self._entries.pop(key, None)
+                if expires_at > now:
+                    self._entries[key] = (value, expires_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if num_lines > 2 * len(self._entries):
+            self._compact()
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as cache_file:
+            for (namespace, key), (value, expires_at) in self._entries.items():
+                cache_file.write(self._serialize(namespace, key, value, expires_at))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _serialize(namespace: str, key: str, value: Any, expires_at: float) -> str:
+        return json.dumps({"namespace": namespace, "key": key, "value": value, "expires_at": expires_at}) + "\n"
+
+    def get(self, namespace: str, key: str) -> Tuple[bool, Any]:
+        """
+        Returns (hit, value). A hit may still carry a None value when a negative result was cached
+        """
+        cache_key = (namespace, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[1] > time():
+                self._entries.move_to_end(cache_key)
+                self.hits[namespace] += 1
+                count("cache_hits", namespace)
+                return True, entry[0]
+            if entry is not None:
+                del self._entries[cache_key]
+            self.misses[namespace] += 1
+            count("cache_misses", namespace)
+            return False, None
+
+    def set(self, namespace: str, key: str, value: Any, ttl_sec: float) -> None:
+        expires_at = time() + ttl_sec
+        with self._lock:
+            self._entries[(namespace, key)] = (value, expires_at)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path:
+                with open(self.path, "a") as cache_file:
+                    cache_file.write(self._serialize(namespace, key, value, expires_at))
+
+    def get_stats(self) -> Dict[str, Tuple[int, int]]:
+        namespaces = set(self.hits) | set(self.misses)
+        return {namespace: (self.hits[namespace], self.misses[namespace]) for namespace in sorted(namespaces)}
+
+    def print_stats(self) -> None:
+        for namespace, (hits, misses) in self.get_stats().items():
+            total = hits + misses
+            hit_rate = round(100 * hits / total, 1) if total else 0.0
+            print(f"Lookup cache [{namespace}]: {hits} hits, {misses} misses ({hit_rate}% hit rate)")
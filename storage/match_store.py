@@ -0,0 +1,269 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+from time import time
+from typing import Optional, Dict, Any, Union, List, Tuple, Iterable
+
+from constants import MATCH_STORE_PATH
+from models.external_models.cod_tracker_models import WarzoneMatch
+from models.external_models.compact_cod_tracker_models import CompactWarzoneMatch
+from schemas.warzone_match_decoder import MatchDecodeError, decode_compact_warzone_match, iter_player_appearances
+
+# SQLite's default limit on bound parameters is 999
+MAX_QUERY_PARAMS = 900
+
+
+class MatchStore:
+    """
+    Persistent SQLite store of downloaded matches, keyed by match_id.
+    Match results never change once played, so entries are never invalidated. Each row keeps the raw JSON returned
+    by tracker.gg (plus its sha256 content hash) and, once parsed, a pickled CompactWarzoneMatch.
+    Every player's kills and deaths in every stored lobby are also indexed by gamertag, so players can be rated
+    from their past appearances without any network calls.
+    Backfills checkpoint their progress through each player's match history here too, so they can resume after a
+    restart.
+    """
+
+    def __init__(self, db_path: str = MATCH_STORE_PATH):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS matches (
+                    match_id TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    raw_json TEXT NOT NULL,
+                    parsed_match BLOB,
+                    fetched_at INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS player_appearances (
+                    gamertag TEXT NOT NULL,
+                    match_id TEXT NOT NULL,
+                    start_time INTEGER,
+                    kills INTEGER NOT NULL,
+                    deaths INTEGER NOT NULL,
+                    team_placement INTEGER,
+                    PRIMARY KEY (gamertag, match_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_player_appearances_match_id ON player_appearances (match_id);
+                CREATE TABLE IF NOT EXISTS backfill_progress (
+                    player_key TEXT PRIMARY KEY,
+                    next_token TEXT,
+                    pages_fetched INTEGER NOT NULL,
+                    completed INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS backfill_match_ids (
+                    player_key TEXT NOT NULL,
+                    match_id TEXT NOT NULL,
+                    start_time INTEGER,
+                    PRIMARY KEY (player_key, match_id)
+                );
+                """
+            )
+        self._index_unindexed_matches()
+
+    def _index_unindexed_matches(self) -> None:
+        """
+        Adds player appearances for matches stored before the appearance index existed
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT match_id, raw_json FROM matches "
+                "WHERE match_id NOT IN (SELECT DISTINCT match_id FROM player_appearances)"
+            ).fetchall()
+        if not rows:
+            return
+        print(f"Indexing player appearances for {len(rows)} stored matches")
+        with self._lock, self._connection:
+            for match_id, raw_json in rows:
+                self._insert_player_appearances(match_id, json.loads(raw_json))
+
+    def _insert_player_appearances(self, match_id: str, raw_match_data: Dict[str, Any]) -> None:
+        try:
+            start_time = int(raw_match_data["metadata"]["timestamp"])
+        except (KeyError, TypeError, ValueError):
+            start_time = None
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO player_appearances VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (gamertag, match_id, start_time, kills, deaths, team_placement)
+                for gamertag, kills, deaths, team_placement in iter_player_appearances(raw_match_data)
+            ],
+        )
+
+    def get_raw_match_data(self, match_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute("SELECT raw_json FROM matches WHERE match_id = ?", (match_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_compact_match(self, match_id: str) -> Optional[CompactWarzoneMatch]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT parsed_match, raw_json FROM matches WHERE match_id = ?", (match_id,)
+            ).fetchone()
+        if not row or row[0] is None:
+            return None
+        try:
+            parsed_match = pickle.loads(row[0])
+        except (pickle.UnpicklingError, AttributeError, ImportError, EOFError, TypeError) as e:
+            # Pickled by an older version of the match models, so decode the stored raw JSON again instead
+            print(f"Re-decoding stored match {match_id} since its parsed copy could not be loaded {repr(e)}")
+            return self._redecode_match(match_id, row[1])
+        if isinstance(parsed_match, WarzoneMatch):
+            # Written before matches were stored in their compact form
+            return CompactWarzoneMatch.from_warzone_match(parsed_match)
+        return parsed_match
+
+    def _redecode_match(self, match_id: str, raw_json: str) -> Optional[CompactWarzoneMatch]:
+        try:
+            compact_match = decode_compact_warzone_match(json.loads(raw_json))
+        except MatchDecodeError:
+            return None
+        self.put_parsed_match(match_id, compact_match)
+        return compact_match
+
+    def get_match(self, match_id: str) -> Optional[WarzoneMatch]:
+        """
+        Returns a fresh copy of the parsed match on every call, so callers are free to mutate it
+        """
+        compact_match = self.get_compact_match(match_id)
+        return compact_match.to_warzone_match() if compact_match else None
+
+    @staticmethod
+    def _pickle_match(warzone_match: Union[WarzoneMatch, CompactWarzoneMatch]) -> bytes:
+        if isinstance(warzone_match, WarzoneMatch):
+            warzone_match = CompactWarzoneMatch.from_warzone_match(warzone_match)
+        return pickle.dumps(warzone_match, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def put_match(
+        self,
+        match_id: str,
+        raw_match_data: Dict[str, Any],
+        warzone_match: Optional[Union[WarzoneMatch, CompactWarzoneMatch]],
+    ) -> None:
+        raw_json = json.dumps(raw_match_data, separators=(",", ":"), sort_keys=True)
+        content_hash = hashlib.sha256(raw_json.encode("utf-8")).hexdigest()
+        parsed_match = self._pickle_match(warzone_match) if warzone_match else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO matches (match_id, content_hash, raw_json, parsed_match, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (match_id, content_hash, raw_json, parsed_match, int(time())),
+            )
+            self._insert_player_appearances(match_id, raw_match_data)
+
+    def put_matches(self, raw_matches: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Stores many unparsed matches in a single transaction. A match that is already stored keeps its parsed copy
+        unless its raw data changed
+        :param raw_matches: (match_id, raw_match_data) pairs
+        """
+        fetched_at = int(time())
+        with self._lock, self._connection:
+            for match_id, raw_match_data in raw_matches:
+                raw_json = json.dumps(raw_match_data, separators=(",", ":"), sort_keys=True)
+                content_hash = hashlib.sha256(raw_json.encode("utf-8")).hexdigest()
+                self._connection.execute(
+                    "INSERT INTO matches (match_id, content_hash, raw_json, parsed_match, fetched_at) "
+                    "VALUES (?, ?, ?, NULL, ?) "
+                    "ON CONFLICT (match_id) DO UPDATE SET content_hash = excluded.content_hash, "
+                    "raw_json = excluded.raw_json, fetched_at = excluded.fetched_at, "
+                    "parsed_match = CASE WHEN matches.content_hash = excluded.content_hash "
+                    "THEN matches.parsed_match END",
+                    (match_id, content_hash, raw_json, fetched_at),
+                )
+                self._insert_player_appearances(match_id, raw_match_data)
+
+    def get_missing_match_ids(self, match_ids: List[str]) -> List[str]:
+        """
+        :return: The given match IDs that aren't stored yet, in the order given
+        """
+        stored = set()
+        for chunk_start in range(0, len(match_ids), MAX_QUERY_PARAMS):
+            chunk = match_ids[chunk_start : chunk_start + MAX_QUERY_PARAMS]
+            query = f"SELECT match_id FROM matches WHERE match_id IN ({','.join('?' * len(chunk))})"
+            with self._lock:
+                stored.update(row[0] for row in self._connection.execute(query, chunk))
+        return [match_id for match_id in match_ids if match_id not in stored]
+
+    def get_backfill_progress(self, player_key: str) -> Optional[Tuple[Optional[str], int, bool]]:
+        """
+        :return: (next pagination token, pages fetched so far, whether the whole history has been walked), or None if
+        no backfill has started for the player
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT next_token, pages_fetched, completed FROM backfill_progress WHERE player_key = ?", (player_key,)
+            ).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def save_backfill_page(
+        self,
+        player_key: str,
+        matches: List[Tuple[str, Optional[int]]],
+        next_token: Optional[str],
+        pages_fetched: int,
+        completed: bool,
+    ) -> None:
+        """
+        Records one page of a player's match history along with the token for the next page, in one transaction so
+        a restart never skips or repeats a page
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO backfill_match_ids VALUES (?, ?, ?)",
+                [(player_key, match_id, start_ts) for match_id, start_ts in matches],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO backfill_progress VALUES (?, ?, ?, ?, ?)",
+                (player_key, next_token, pages_fetched, int(completed), int(time())),
+            )
+
+    def get_backfill_match_ids(self, player_key: str) -> List[Tuple[str, Optional[int]]]:
+        """
+        :return: (match_id, start timestamp) pairs found by the player's backfill, most recent first
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT match_id, start_time FROM backfill_match_ids WHERE player_key = ? "
+                "ORDER BY start_time DESC, match_id DESC",
+                (player_key,),
+            ).fetchall()
+
+    def clear_backfill_progress(self, player_key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM backfill_progress WHERE player_key = ?", (player_key,))
+            self._connection.execute("DELETE FROM backfill_match_ids WHERE player_key = ?", (player_key,))
+
+    def get_player_kill_death_totals(
+        self, gamertags: List[str], exclude_match_id: Optional[str] = None, since_ts: Optional[int] = None
+    ) -> Dict[str, Tuple[int, int, int]]:
+        """
+        Sums each player's kills and deaths over the stored matches they appear in
+        :param gamertags:
+        :param exclude_match_id: Usually the match being analysed, so a player isn't rated on that game alone
+        :param since_ts: Only count matches that started at or after this time
+        :return: Mapping of gamertag to (kills, deaths, matches) for players with at least one appearance
+        """
+        totals = {}
+        for chunk_start in range(0, len(gamertags), MAX_QUERY_PARAMS):
+            chunk = gamertags[chunk_start : chunk_start + MAX_QUERY_PARAMS]
+            query = (
+                "SELECT gamertag, SUM(kills), SUM(deaths), COUNT(*) FROM player_appearances "
+                f"WHERE gamertag IN ({','.join('?' * len(chunk))}) AND match_id != ? AND start_time >= ? "
+                "GROUP BY gamertag"
+            )
+            params = chunk + [exclude_match_id or "", since_ts if since_ts is not None else 0]
+            with self._lock:
+                for gamertag, kills, deaths, num_matches in self._connection.execute(query, params):
+                    totals[gamertag] = (kills, deaths, num_matches)
+        return totals
+
+    def put_parsed_match(self, match_id: str, warzone_match: Union[WarzoneMatch, CompactWarzoneMatch]) -> None:
+        parsed_match = self._pickle_match(warzone_match)
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE matches SET parsed_match = ? WHERE match_id = ?", (parsed_match, match_id))
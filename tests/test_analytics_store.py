@@ -0,0 +1,33 @@
+import unittest
+
+from models.external_models.cod_tracker_models import WarzonePlayerStats
+from storage.analytics_store import AnalyticsStore
+
+
+class AnalyticsStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = AnalyticsStore(":memory:")
+        self.store.record_player_matches(
+            "Noah",
+            [
+                ("1", 100, "BR Quads", "Noah|Ravi", WarzonePlayerStats(kills=5, deaths=1, team_placement=1)),
+                ("2", 200, "BR Quads", "Noah|Ravi", WarzonePlayerStats(kills=2, deaths=2, team_placement=12)),
+                # The decoder stores 0 when a match has no placement
+                ("3", 300, "BR Quads", "Noah|Ravi", WarzonePlayerStats(kills=1, deaths=3, team_placement=0)),
+                ("4", 400, "BR Quads", "Noah|Ravi", WarzonePlayerStats(kills=0, deaths=1)),
+            ],
+        )
+
+    def test_missing_placement_is_not_a_win_or_top_five(self):
+        self.assertEqual(self.store.get_win_rate(player="Noah"), 0.25)
+        self.assertEqual(self.store.get_top_five_rate(player="Noah"), 0.25)
+
+    def test_summary_ignores_missing_placement(self):
+        (summary,) = self.store.get_summary(group_by="player")
+        self.assertEqual(summary["games"], 4)
+        self.assertEqual(summary["win_rate"], 0.25)
+        self.assertEqual(summary["top_five_rate"], 0.25)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import functools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Dict, Tuple, Optional, Iterator, Callable, Any
+
+PROMETHEUS_PREFIX = "warzone"
+
+# (name, label) e.g. ("http", "match") or ("cache_hits", "l7d_kd"). The label is "" when there isn't one
+MetricKey = Tuple[str, str]
+
+
+@dataclass
+class StageTiming:
+    calls: int = 0
+    total_sec: float = 0.0
+    max_sec: float = 0.0
+
+    def add(self, elapsed_sec: float) -> None:
+        self.calls += 1
+        self.total_sec += elapsed_sec
+        self.max_sec = max(self.max_sec, elapsed_sec)
+
+
+class Instrumentation:
+    """
+    Thread-safe registry of stage timings and counters for one run
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings: Dict[MetricKey, StageTiming] = {}
+        self.counters: Dict[MetricKey, float] = {}
+
+    def record_time(self, stage: str, elapsed_sec: float, label: str = "") -> None:
+        with self._lock:
+            self.timings.setdefault((stage, label), StageTiming()).add(elapsed_sec)
+
+    def count(self, name: str, label: str = "", amount: float = 1) -> None:
+        with self._lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    @contextmanager
+    def timer(self, stage: str, label: str = "") -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(stage, perf_counter() - start, label)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "timings": [
+                    {"stage": stage, "label": label, "calls": t.calls, "total_sec": t.total_sec, "max_sec": t.max_sec}
+                    for (stage, label), t in sorted(self.timings.items())
+                ],
+                "counters": [
+                    {"name": name, "label": label, "value": value}
+                    for (name, label), value in sorted(self.counters.items())
+                ],
+            }
+
+    def print_summary(self) -> None:
+        data = self.to_dict()
+        print("\nRun summary (stage totals are summed across threads, so concurrent stages can exceed the run time)")
+        print(f"{'Stage':<50}{'Calls':>8}{'Total (s)':>12}{'Max (s)':>10}")
+        for timing in sorted(data["timings"], key=lambda t: t["total_sec"], reverse=True):
+            name = f"{timing['stage']}[{timing['label']}]" if timing["label"] else timing["stage"]
+            print(f"{name:<50}{timing['calls']:>8}{timing['total_sec']:>12.3f}{timing['max_sec']:>10.3f}")
+        if data["counters"]:
+            print(f"\n{'Counter':<50}{'Value':>12}")
+        for counter in data["counters"]:
+            name = f"{counter['name']}[{counter['label']}]" if counter["label"] else counter["name"]
+            print(f"{name:<50}{round(counter['value'], 3):>12}")
+
+    @staticmethod
+    def _write_atomically(path: str, contents: str) -> None:
+        # Dashboards scrape these files on their own schedule, so never let them see a half written one
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+    def dump_json(self, path: str) -> None:
+        self._write_atomically(path, json.dumps(self.to_dict(), indent=2))
+
+    def dump_prometheus(self, path: str) -> None:
+        """
+        Writes the metrics in the Prometheus text format, for node_exporter's textfile collector
+        """
+        data = self.to_dict()
+        lines = []
+        for metric, field, help_text in (
+            ("stage_seconds_total", "total_sec", "Time spent in each stage"),
+            ("stage_calls_total", "calls", "Times each stage ran"),
+        ):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} counter")
+            for timing in data["timings"]:
+                lines.append(
+                    f'{PROMETHEUS_PREFIX}_{metric}{{stage="{timing["stage"]}",label="{timing["label"]}"}} '
+                    f"{timing[field]}"
+                )
+        for name in sorted(set(counter["name"] for counter in data["counters"])):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+            for counter in data["counters"]:
+                if counter["name"] == name:
+                    lines.append(f'{PROMETHEUS_PREFIX}_{name}_total{{label="{counter["label"]}"}} {counter["value"]}')
+        self._write_atomically(path, "\n".join(lines) + "\n")
+
+
+# Shared by the whole process so instrumented code doesn't have to pass a registry around
+INSTRUMENTATION = Instrumentation()
+
+
+def timer(stage: str, label: str = ""):
+    return INSTRUMENTATION.timer(stage, label)
+
+
+def count(name: str, label: str = "", amount: float = 1) -> None:
+    INSTRUMENTATION.count(name, label, amount)
+
+
+def timed(stage: str, label: str = "") -> Callable:
+    """
+    Decorator version of timer()
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage, label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def print_summary() -> None:
+    INSTRUMENTATION.print_summary()
+
+
+def dump(json_path: Optional[str] = None, prometheus_path: Optional[str] = None) -> None:
+    if json_path:
+        INSTRUMENTATION.dump_json(json_path)
+    if prometheus_path:
+        INSTRUMENTATION.dump_prometheus(prometheus_path)
@@ -0,0 +1,34 @@
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucketRateLimiter:
+    """
+    Thread-safe token bucket. Each call to acquire() consumes one token, blocking until one is available.
+    Tokens refill continuously at `requests_per_second`, up to `burst` tokens banked at once.
+    """
+
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        if requests_per_second <= 0:
+            raise ValueError("requests_per_second must be positive")
+        self.requests_per_second = requests_per_second
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last_refill = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        elapsed = now - self._last_refill
+        self._tokens = min(self.burst, self._tokens + elapsed * self.requests_per_second)
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.requests_per_second
+            sleep(wait_time)
@@ -0,0 +1,41 @@
+import threading
+from concurrent.futures import Future
+from typing import Dict, Hashable, Callable, Any
+
+from utils.instrumentation import count
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key. The first caller runs the function and everyone asking for that key
+    while it's in flight waits for and shares its result (or exception). Nothing is kept once the call finishes, so
+    callers should put the result somewhere later callers will find it (e.g. the match store) inside the call
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+        if not is_leader:
+            count("single_flight_shared", self.name)
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]